@@ -21,20 +21,67 @@
 # -------------------------------------------------------------------------------------------------
 
 import argparse
+import atexit
 import base64
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import copy
+import gzip
+import hashlib
+import io
+import json
 import os
 import re
+import subprocess
 from subprocess import check_output
+import threading
+import time
 import xml.etree.ElementTree as ET
+import xml.parsers.expat
+import zipfile
 
 # ---- globals
 
+# kbb version, changing this forces incremental builds to rebuild all outputs
+#
+gVersion = "0.2"
+
 gLogFile = os.path.normpath("./kbb_log.txt")
 
+# log sink state: gLogSink is the log file, opened once per run by OpenLog(), gLogFormat selects
+# "text" or "json" (json-lines) output, and messages below gLogLevel are not logged. gLogContext
+# holds fields (such as group and flight) added to json log records.
+#
+gLogSink = None
+gLogFormat = "text"
+gLogLevels = { "debug" : 0, "info" : 1, "warn" : 2, "error" : 3 }
+gLogLevel = 0
+gLogContext = { }
+gLogStart = time.time()
+
+# when not None, Log() appends ( record, echo ) tuples to this array rather than writing them out.
+# build jobs running in worker processes use this to hand their log back to the main process.
+#
+gLogBuffer = None
+
 # svg "tag" regex, first capture is the key, second capture is (option) parameters.
 #
 gTagRegex = re.compile(r"#([^#;]+)[;]*([^#]*)#")
 
+# csv special character regex, matches the characters ReadCSV() needs to look at.
+#
+gCSVSpecialRegex = re.compile(r'[",]')
+
+# xlsx cell reference regex, first capture is the column letters.
+#
+gXLSXCellRegex = re.compile(r"^([A-Za-z]+)")
+
+# xlsx xml namespaces for spreadsheet elements and relationships.
+#
+gXLSXNS = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
+gXLSXRelNS = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}"
+gXLSXPkgRelNS = "{http://schemas.openxmlformats.org/package/2006/relationships}"
+
 # replacement regex, first capture is group id, second is the parameters.
 #
 gRepRegex = re.compile(r"^([^.]*)[\s]*:[\s]*([^.]+)")
@@ -47,32 +94,195 @@ gRepCoordRegex = re.compile(r"^r_(n|[\d]+)_c_(n|[\d]+)$")
 #
 gTmpltSearch = [ ".", "./templates" ]
 
+# cache of parsed templates, maps resolved template path to a ( mtime, element tree, index, slots )
+# tuple (see IndexSVG() for the index and CopyInSVG() for the slots). the cache is ordered from
+# least to most recently used and holds at most gTmpltCacheSize trees.
+#
+gTmpltCache = OrderedDict()
+gTmpltCacheSize = 8
+
+# cache of byte offset indexes for element libraries, maps resolved library path to a ( mtime,
+# offsets ) tuple (see IndexSVGOffsets() for the offsets). elements are only indexed down to
+# gSVGOffsetDepth levels below the root, but the ids of all elements are kept so that looking up
+# an id the library does not have does not read the library again.
+#
+gSVGOffsetCache = { }
+gSVGOffsetDepth = 2
+
+# output options for .svg files: minify strips editor data and unused defs (see MinifySVG()) and
+# compress writes gzip compressed .svgz files.
+#
+gSVGMinify = False
+gSVGCompress = False
+
+# cache of .png replacements, maps ( resolved path, width, height ) from a .png identifier to an
+# ( mtime, element tree, index, slots ) tuple as gTmpltCache does. .png files are only read and
+# encoded once per run. if gPNGResample is true, images larger than their slot are downsampled to
+# fit the slot before they are encoded (this requires the pillow package).
+#
+gPNGCache = { }
+gPNGResample = False
+
+# dark templates (with names ending in "_Dk") that do not exist are derived from the light template
+# with the same name (less the "_Dk") by remapping its colors, see DeriveDarkSVG(). _Dk templates
+# that exist are always used as is, derivation only stands in for a missing one. if gTmpltDark is
+# true, the dark variant of every template is used.
+#
+gTmpltDark = False
+
+# color remap rules for deriving dark templates, ( tag, attribute, light color, dark color, id )
+# tuples. a rule with a tag of None applies to any element, a rule with an id only applies to the
+# element with that (sanitized) id. the first rule that matches an element applies. colors are
+# uppercase. the rules reproduce the colors of the _Dk templates in templates/ from their light
+# templates (tests/test_kbb.py checks this), rules with ids pick out the fields those templates
+# color differently (card headers and footers, base names and details).
+#
+gDarkRemap = [
+    ( "text", "fill", "#E0E0E0", "#E0E0E0", "field:-header" ),
+    ( "text", "fill", "#E0E0E0", "#C0C0C0", "field:-footer-r" ),
+    ( "text", "fill", "#E0E0E0", "#FFFFFF", "field:-icao" ),
+    ( "text", "fill", "#E0E0E0", "#FFFFFF", "field:-name" ),
+    ( "text", "fill", "#E0E0E0", "#FFFFFF", "field:-ll-/-elevation" ),
+    ( "text", "fill", "#E0E0E0", "#232323", None ),
+    ( "rect", "fill", "#E0E0E0", "#000000", "background" ),
+    ( "rect", "fill", "#E0E0E0", "#232323", None ),
+    ( "text", "fill", "#181818", "#FFFFFF", None ),
+    ( "text", "fill", "#707070", "#808080", None ),
+    ( "g", "fill", "#707070", "#808080", None ),
+    ( None, "fill", "#707070", "#5B5B5B", None ),
+    ( None, "stroke", "#707070", "#5B5B5B", None )
+]
+
+# gDarkRemap compiled by DeriveDarkSVG() on first use, maps ( tag, attribute, light color ) onto
+# an array of ( id, dark color ) tuples in rule order.
+#
+gDarkRemapIndex = None
+
+# svg namespace, namespaces of editor data stripped by MinifySVG(), and regex to match references
+# to ids in url() values
+#
+gSVGNS = "{http://www.w3.org/2000/svg}"
+gSVGEditorNS = ( "{http://www.inkscape.org/namespaces/inkscape}", "{http://sodipodi.sourceforge.net/DTD/sodipodi-0.dtd}" )
+gSVGURLRegex = re.compile(r"url\(\s*['\"]?#([^)'\"\s]+)")
+
+# rasterizer used to convert output svg files to png, see NewRasterizer(). this is set up in the
+# main process and, for in-memory rasterizers, worker processes.
+#
+gRasterizer = None
+
+# inkscape executable used by the inkscape rasterizers
+#
+gInkscape = "inkscape.com"
+
+# build manifest for incremental builds, maps output base path (relative to the output directory)
+# to the hash of the inputs the output was built from, see HashVariant(). None if incremental
+# builds are not in use.
+#
+gManifest = None
+gManifestFile = "kbb_manifest.json"
+
 # ------------------------------------
-# output a message to the log file (kbb_log.txt) and, optionally, stdout.
+# open the log sink at gLogFile for the run, json selects json-lines output. the sink is buffered
+# and closed (flushing the buffer) at exit.
 #
-def Log(msg, isEcho=False):
+def OpenLog(isJSON=False):
     global gLogFile
+    global gLogSink
+    global gLogFormat
+
+    gLogFormat = "json" if isJSON else "text"
+    gLogSink = open(gLogFile, "w", encoding="utf-8", buffering=1024 * 1024)
+    atexit.register(CloseLog)
+
+# ------------------------------------
+# flush and close the log sink, if it is open.
+#
+def CloseLog():
+    global gLogSink
 
-    if gLogFile is not None:
-        with open(gLogFile, "a") as f:
-            f.write(f"{msg}\n")
+    if gLogSink is not None:
+        gLogSink.close()
+        gLogSink = None
+
+# ------------------------------------
+# write a log record ( time, level, message, fields ) from Log() to the log sink (unless fields is
+# None) and, optionally, stdout.
+#
+def WriteLog(record, isEcho):
+    global gLogSink
+    global gLogFormat
+    global gLogStart
+
+    t, level, msg, fields = record
+    if gLogSink is not None and fields is not None:
+        if gLogFormat == "json":
+            gLogSink.write(json.dumps({ "time" : round(t - gLogStart, 3), "level" : level, **fields, "msg" : msg }) + "\n")
+        else:
+            gLogSink.write(f"{msg}\n")
     if isEcho:
         print(msg)
 
+# ------------------------------------
+# output a message to the log file (kbb_log.txt) and, optionally, stdout. level is one of the
+# gLogLevels keys, messages below gLogLevel only go to stdout (if echoed). fields are added to the
+# fields from gLogContext in json log records.
+#
+def Log(msg, isEcho=False, level="info", **fields):
+    global gLogFile
+    global gLogLevels
+    global gLogLevel
+    global gLogContext
+    global gLogBuffer
+
+    # fields are None for records that are only echoed to stdout, not logged.
+    isLogged = gLogFile is not None and gLogLevels[level] >= gLogLevel
+    if not isLogged and not isEcho:
+        return
+    record = ( time.time(), level, msg, { **gLogContext, **fields } if isLogged else None )
+
+    if gLogBuffer is not None:
+        gLogBuffer.append(( record, isEcho ))
+    else:
+        WriteLog(record, isEcho)
+
 # ------------------------------------
 # find a template file at one of the paths in gTmpltSearch.  returns path to the file if found,
 # None if not
 #
 def FindTemplate(name):
     global gTmpltSearch
+    global gTmpltDark
 
+    if gTmpltDark:
+        name = DarkTemplateName(name)
     for path in gTmpltSearch:
         tPath = os.path.normpath(f"{path}/{name}")
-        Log(f"CHECK: {tPath}")
-        if os.path.exists(tPath):
+        Log(f"CHECK: {tPath}", level="debug")
+        if os.path.exists(tPath) or FindDarkSource(tPath) is not None:
             return tPath
     return None
 
+# ------------------------------------
+# returns the name of the dark variant of an .svg template, "<name>_Dk.svg". other files and dark
+# templates are returned as is.
+#
+def DarkTemplateName(name):
+    base, ext = os.path.splitext(name)
+    if ext.lower() != ".svg" or base.lower().endswith("_dk"):
+        return name
+    return f"{base}_Dk{ext}"
+
+# ------------------------------------
+# returns the path of the light template that the dark template at path is derived from, None if
+# the template at path exists or is not a dark template with a light template to derive it from.
+#
+def FindDarkSource(path):
+    base, ext = os.path.splitext(path)
+    if os.path.exists(path) or ext.lower() != ".svg" or not base.lower().endswith("_dk"):
+        return None
+    pathLight = f"{base[:-3]}{ext}"
+    return pathLight if os.path.exists(pathLight) else None
+
 # ------------------------------------
 # a sanitized key has no leading or trailing whitespace, has all spaces replaced with "_", and
 # is lowercase. returns sanitized key (note sanitizing None returns None)
@@ -185,57 +395,61 @@ def ReadEdits(path):
 
 # ------------------------------------
 # read a .csv file at the given path, ignoring lines that begin with "#" (this is outside the
-# .csv spec). returns an array of ( row number, row columns ) tuples, where row columns is an
-# array with the columns from the .csv. raises an exception on error.
+# .csv spec). this is a generator that yields ( row number, row columns ) tuples as the file is
+# read, where row columns is an array with the columns from the .csv. raises an exception on error.
 #
 def ReadCSV(path):
+    global gCSVSpecialRegex
+
     try:
         with open(path, "r") as f:
-            lines = f.readlines()
-        # HACK: excel can export .csv as utf-8 with a bom, ugh. strip the bom if it's around
-        if lines[0][:3] == "ï»¿":
-            lines[0] = lines[0][3:]
+            fields = [ ]
+            field = [ ]                                         # non-empty pieces of the field
+            depthDQ = 0
+            nRow = 0
+            isFirst = True
+            for line in f:
+                # HACK: excel can export .csv as utf-8 with a bom, ugh. strip the bom if it's around
+                if isFirst:
+                    line = line.removeprefix("ï»¿").removeprefix("\ufeff")
+                    isFirst = False
+                line = line.strip()                             # zap leading, trailing whitespace
+                if len(line) > 0 and line[0] == "#":            # comment, though not per .csv spec
+                    nRow += 1
+                    continue
+                iStart = 0
+                for match in gCSVSpecialRegex.finditer(line):
+                    iCh = match.start()
+                    field.append(line[iStart:iCh+1])            # assume accumulate, back out later
+                    iStart = iCh + 1
+                    if line[iCh] == "\"":
+                        if depthDQ == 0:                        # open double quote
+                            depthDQ = depthDQ + 1
+                        elif line[iCh:iCh+2] == "\"\"":         # first quote of quoted double quote
+                            pass
+                        elif iCh > 0 and line[iCh-1] == "\"":   # second quote of quoted double quote
+                            field[-1] = field[-1][:-1]
+                            if len(field[-1]) == 0:
+                                field.pop()
+                        else:                                   # close double quote
+                            depthDQ = depthDQ - 1
+                    elif depthDQ == 0:                          # field delimiter
+                        fields.append(CleanupCSVColumn("".join(field)[:-1]))
+                        field = [ ]
+                if iStart < len(line):
+                    field.append(line[iStart:])
+
+                if len(field) > 0 and depthDQ > 0:
+                    field.append("\n")
+                else:
+                    nRow += 1
+                    fields.append(CleanupCSVColumn("".join(field)))
+                    if len(fields) > 1 or len(fields[0]) > 0:
+                        yield ( nRow, fields )
+                    fields = [ ]
+                    field = [ ]
     except Exception as ex:
         raise Exception(f"Unable to read CSV definition file: {path}, {ex}")
-    else:
-        data = [ ]
-        fields = [ ]
-        field = ""
-        depthDQ = 0
-        nRow = 0
-        for iLn in range(len(lines)):
-            line = lines[iLn].rstrip().lstrip()                 # zap leading, trailing whitespace
-            if len(line) > 0 and line[0] == "#":                # comment, though not per .csv spec
-                nRow += 1
-                continue
-            for iCh in range(len(line)):
-                field = f"{field}{line[iCh]}"                   # assume accumulate, back out later
-                if line[iCh] == "\"":
-                    if depthDQ == 0:                            # open double quote
-                        depthDQ = depthDQ + 1
-                        continue
-                    elif line[iCh:iCh+2] == "\"\"":             # first quote of quoted double quote
-                        continue
-                    elif line[iCh-1:iCh+1] == "\"\"":           # second quote of quoted double quote
-                        field = field[:-1]
-                        continue
-                    else:                                       # close double quote
-                        depthDQ = depthDQ - 1
-                elif line[iCh] == "," and depthDQ == 0:         # field delimiter
-                    fields.append(CleanupCSVColumn(field[:-1]))
-                    field = ""
-
-            if len(field) > 0 and depthDQ > 0:
-                field = f"{field}\n"
-            else:
-                nRow += 1
-                fields.append(CleanupCSVColumn(field))
-                if len(fields) > 1 or len(fields[0]) > 0:
-                    data.append(( nRow, fields ))
-                fields = [ ]
-                field = ""
-        
-        return data
 
 # ------------------------------------
 # clean up a column field from a .csv by removing outter double quotes and outter whitespace.
@@ -256,7 +470,7 @@ def CleanupCSVColumn(col):
 # "description" and "field" (case insensitive) in the first two columns and run until the end
 # of the csv or the next description/field row.
 #
-# csv is an array of ( row number, row columns ) tuples from ReadCSV(). returns an array of an
+# csv is an iterable of ( row number, row columns ) tuples from ReadCSV(). returns an array of an
 # array of ( row number, row columns ) tuples. first array is indexed by group number, second by
 # row within the group.
 #
@@ -278,7 +492,7 @@ def CrackGroupsFromCSV(csv):
             group = [ rowTuple ]
         elif group is not None:
             # ensure row has column for each column in the header, then append group
-            for iCol in range(len(rowCols), len(group[0])):
+            for iCol in range(len(rowCols), len(group[0][1])):
                 rowTuple[1].append("")
             group.append(rowTuple)
 
@@ -287,6 +501,160 @@ def CrackGroupsFromCSV(csv):
 
     return groups
 
+# -------------------------------------------------------------------------------------------------
+#
+# xlsx file handling
+#
+# -------------------------------------------------------------------------------------------------
+
+# ------------------------------------
+# returns the path of a workbook part within an .xlsx archive given the target of a relationship
+# from xl/_rels/workbook.xml.rels.
+#
+def XLSXPartPath(target):
+    if target.startswith("/"):
+        return target[1:]
+    return os.path.normpath(f"xl/{target}").replace("\\", "/")
+
+# ------------------------------------
+# read the shared strings table from an open .xlsx archive at the given part path (may be None).
+# returns an array of strings indexed by shared string number.
+#
+def ReadXLSXSharedStrings(xlsx, path):
+    global gXLSXNS
+
+    strings = [ ]
+    if path is None or path not in xlsx.namelist():
+        return strings
+    with xlsx.open(path) as f:
+        stack = [ ]
+        for event, elem in ET.iterparse(f, events=( "start", "end" )):
+            if event == "start":
+                stack.append(elem)
+                continue
+            stack.pop()
+            if elem.tag == f"{gXLSXNS}si":
+                # rich text strings are split over runs, phonetic (rPh) runs are not part of the text
+                texts = [ ]
+                for child in elem:
+                    if child.tag == f"{gXLSXNS}t":
+                        texts.append(child.text or "")
+                    elif child.tag == f"{gXLSXNS}r":
+                        texts.extend([ t.text or "" for t in child.iter(f"{gXLSXNS}t") ])
+                strings.append("".join(texts))
+                # drop the string from the table so the partial tree does not grow with the table.
+                stack[-1].remove(elem)
+    return strings
+
+# ------------------------------------
+# returns the text value of a cell element from an .xlsx worksheet as a .csv export would present
+# it: shared and inline strings are looked up, booleans are TRUE/FALSE, and numbers are shown
+# without a trailing ".0". lines in multiline text have outer whitespace removed, matching the
+# per-line cleanup ReadCSV() does.
+#
+def XLSXCellValue(cell, strings):
+    global gXLSXNS
+
+    type = cell.get("t", "n")
+    if type == "inlineStr":
+        value = "".join([ t.text or "" for t in cell.iter(f"{gXLSXNS}t") ])
+    else:
+        elemV = cell.find(f"{gXLSXNS}v")
+        value = elemV.text if elemV is not None and elemV.text is not None else ""
+        if type == "s" and len(value) > 0:
+            value = strings[int(value)]
+        elif type == "b":
+            value = "TRUE" if value == "1" else "FALSE"
+        elif type == "n" and len(value) > 0:
+            number = float(value)
+            if number.is_integer() and "e" not in value.lower():
+                value = str(int(number))
+    return "\n".join([ line.strip() for line in value.split("\n") ])
+
+# ------------------------------------
+# returns the zero-based column index for a cell reference ("C12" is column 2).
+#
+def XLSXColumnIndex(ref):
+    global gXLSXCellRegex
+
+    index = 0
+    for ch in gXLSXCellRegex.match(ref).group(1).upper():
+        index = index * 26 + (ord(ch) - ord("A") + 1)
+    return index - 1
+
+# ------------------------------------
+# stream the rows of a worksheet from an open .xlsx archive at the given part path. this is a
+# generator that yields ( row number, row columns ) tuples as ReadCSV() does, skipping empty rows
+# and rows with a first column that begins with "#".
+#
+def ReadXLSXSheet(xlsx, path, strings):
+    global gXLSXNS
+
+    with xlsx.open(path) as f:
+        stack = [ ]
+        for event, elem in ET.iterparse(f, events=( "start", "end" )):
+            if event == "start":
+                stack.append(elem)
+                continue
+            stack.pop()
+            if elem.tag != f"{gXLSXNS}row":
+                continue
+            nRow = int(elem.get("r"))
+            fields = [ ]
+            for cell in elem.iter(f"{gXLSXNS}c"):
+                ref = cell.get("r")
+                iCol = XLSXColumnIndex(ref) if ref is not None else len(fields)
+                while len(fields) < iCol:
+                    fields.append("")
+                fields.append(CleanupCSVColumn(XLSXCellValue(cell, strings)))
+            # drop the row from <sheetData> (clearing it would leave an empty element behind for
+            # every row) so the partial tree does not grow with the sheet.
+            stack[-1].remove(elem)
+
+            while len(fields) > 0 and len(fields[-1]) == 0:
+                fields.pop()
+            if len(fields) > 0 and fields[0][:1] != "#":
+                yield ( nRow, fields )
+
+# ------------------------------------
+# read an .xlsx workbook at the given path. this is a generator that yields a ( sheet name, rows )
+# tuple for each worksheet in workbook order, where rows is a generator of ( row number, row
+# columns ) tuples from ReadXLSXSheet(). if sheets is non-empty, only worksheets with names in
+# sheets (case-insensitive) are read. raises an exception on error, including a name in sheets that
+# does not match a worksheet in the workbook.
+#
+def ReadXLSX(path, sheets=None):
+    global gXLSXNS
+    global gXLSXRelNS
+    global gXLSXPkgRelNS
+
+    sheetsSel = [ x.lower() for x in sheets ] if sheets else None
+    try:
+        with zipfile.ZipFile(path) as xlsx:
+            rels = { }
+            pathStrings = None
+            root = ET.fromstring(xlsx.read("xl/_rels/workbook.xml.rels"))
+            for rel in root.iter(f"{gXLSXPkgRelNS}Relationship"):
+                rels[rel.get("Id")] = XLSXPartPath(rel.get("Target"))
+                if rel.get("Type").endswith("/sharedStrings"):
+                    pathStrings = rels[rel.get("Id")]
+            strings = ReadXLSXSharedStrings(xlsx, pathStrings)
+
+            root = ET.fromstring(xlsx.read("xl/workbook.xml"))
+            names = [ sheet.get("name") for sheet in root.iter(f"{gXLSXNS}sheet") ]
+            if sheetsSel is not None:
+                missing = [ x for x in sheets if x.lower() not in [ name.lower() for name in names ] ]
+                if len(missing) > 0:
+                    raise Exception(f"No worksheet named {', '.join(missing)}, workbook has {', '.join(names)}")
+            for sheet in root.iter(f"{gXLSXNS}sheet"):
+                name = sheet.get("name")
+                if sheetsSel is not None and name.lower() not in sheetsSel:
+                    continue
+                Log(f"Reading sheet \"{name}\" from {path}")
+                yield ( name, ReadXLSXSheet(xlsx, rels[sheet.get(f"{gXLSXRelNS}id")], strings) )
+    except Exception as ex:
+        raise Exception(f"Unable to read XLSX definition file: {path}, {ex}")
+
 # -------------------------------------------------------------------------------------------------
 #
 # png file handling
@@ -294,17 +662,75 @@ def CrackGroupsFromCSV(csv):
 # -------------------------------------------------------------------------------------------------
 
 # ------------------------------------
-# read the svg at the specified path and encapsulate it in an svg element. returns an element tree
-# with the encapsulated png, raises an exception if there was an error.
+# read the png at the specified path through the png cache. returns an ( element tree, index, slots )
+# tuple as ReadSVGCached() does for the svg from ReadPNG(), these are shared with other callers and
+# must not be edited. raises an exception if there was an error.
 #
-def ReadPNG(path, id):
+def ReadPNGCached(path, id):
+    global gPNGCache
+
+    w, h = CrackPNGID(id)
+    try:
+        key = ( os.path.realpath(path), w, h )
+        mtime = os.path.getmtime(key[0])
+    except Exception as ex:
+        raise Exception(f'Unable to read PNG file "{path}", {ex}')
+
+    if key not in gPNGCache or gPNGCache[key][0] != mtime:
+        Log(f"Caching encoded image {key}", level="debug")
+        xmlTree = ReadPNG(path, id)
+        gPNGCache[key] = ( mtime, xmlTree, IndexSVG(None, xmlTree.getroot(), { }), { } )
+    return gPNGCache[key][1:]
+
+# ------------------------------------
+# returns the ( width, height ) strings from a .png identifier, ".png <w> <h>". raises an exception
+# if the identifier is poorly formed.
+#
+def CrackPNGID(id):
     fields = id.replace("_", " ").split(" ")
     if len(fields) != 3:
         raise Exception(f"Incorrectly formed .PNG identifier, \"{id}\"")
-    w = fields[1]
-    h = fields[2]
+    return ( fields[1], fields[2] )
+
+# ------------------------------------
+# returns the contents of the png at the specified path downsampled to fit within a w x h slot,
+# preserving its aspect ratio (as the <image> that displays it does). returns the contents of the
+# file if the image already fits or if downsampling does not make it smaller. raises an exception if
+# there was an error.
+#
+def ResamplePNG(path, w, h):
+    try:
+        from PIL import Image
+    except ImportError as ex:
+        raise Exception(f"Resampling .png files requires the pillow package, {ex}")
+
     with open(path, "rb") as fh:
-        data = base64.b64encode(fh.read()).decode('utf-8')
+        data = fh.read()
+    size = ( max(round(float(w)), 1), max(round(float(h)), 1) )
+    with Image.open(io.BytesIO(data)) as image:
+        if image.width <= size[0] and image.height <= size[1]:
+            return data
+        if image.mode not in ( "RGB", "RGBA", "L", "LA" ):
+            image = image.convert("RGBA")
+        image.thumbnail(size, Image.LANCZOS)
+        buffer = io.BytesIO()
+        image.save(buffer, format="PNG", optimize=True)
+    Log(f"Resampled {path} to {image.width}x{image.height}, {len(data)} to {buffer.tell()} bytes", level="debug")
+    return buffer.getvalue() if buffer.tell() < len(data) else data
+
+# ------------------------------------
+# read the png at the specified path and encapsulate it in an svg element. returns an element tree
+# with the encapsulated png, raises an exception if there was an error.
+#
+def ReadPNG(path, id):
+    global gPNGResample
+
+    w, h = CrackPNGID(id)
+    if gPNGResample:
+        data = base64.b64encode(ResamplePNG(path, w, h)).decode('utf-8')
+    else:
+        with open(path, "rb") as fh:
+            data = base64.b64encode(fh.read()).decode('utf-8')
     xml = f'''<svg width="{w}" height="{h}" xmlns="http://www.w3.org/2000/svg">
                 <image id=".png" href="data:image/png;base64,{data}" width="{w}" height="{h}" />
               </svg>'''
@@ -321,61 +747,405 @@ def ReadPNG(path, id):
 # raises an exception if there was an error.
 #
 def ReadSVG(path):
-    xml = ""
     try:
-        with open(path) as f:
-            for line in f.readlines():
-                xml = xml + line
-        xmlTree = ET.ElementTree(ET.fromstring(xml))
+        xmlTree = ET.parse(path)
     except Exception as ex:
         raise Exception(f'Unable to read SVG file "{path}", {ex}')
     else:
         return xmlTree
 
 # ------------------------------------
-# write the svg rooted at the given xml root to the specified path. raises an exception if there
-# was an error.
+# read the svg at the specified path through the template cache. returns an ( element tree, index,
+# slots ) tuple with the parsed xml, its IndexSVG() index, and its compiled tag slots. these are
+# shared with other callers and must not be edited (use CopyInSVG() on the subtree of interest).
+# raises an exception if there was an error.
+#
+def ReadSVGCached(path):
+    global gTmpltCache
+
+    pathLight = FindDarkSource(path)
+    try:
+        key = os.path.realpath(path if pathLight is None else pathLight)
+        mtime = os.path.getmtime(key)
+    except Exception as ex:
+        raise Exception(f'Unable to read SVG file "{path}", {ex}')
+    if pathLight is not None:
+        key = ( key, "dark" )
+
+    if key in gTmpltCache and gTmpltCache[key][0] == mtime:
+        gTmpltCache.move_to_end(key)
+        return gTmpltCache[key][1:]
+
+    if pathLight is None:
+        xmlTree = ReadSVG(path)
+    else:
+        # derived dark templates start from the (cached) light template, which is only parsed once
+        # for both variants.
+        Log(f"Deriving dark template {path} from {pathLight}", level="debug")
+        xmlTree = ET.ElementTree(copy.deepcopy(ReadSVGCached(pathLight)[0].getroot()))
+        DeriveDarkSVG(xmlTree.getroot(), os.path.splitext(os.path.basename(path))[0])
+    return CacheSVG(key, mtime, xmlTree)
+
+# ------------------------------------
+# read the first element with the given (sanitized) id from the svg library at the specified path
+# through the template cache. returns an ( element tree, index, slots ) tuple as ReadSVGCached()
+# does, where the tree is rooted at the element. the tree is None (and the index and slots are
+# empty) if there is no such element. raises an exception if there was an error.
+#
+def ReadSVGElementCached(path, id):
+    global gTmpltCache
+
+    pathLight = FindDarkSource(path)
+    try:
+        key = os.path.realpath(path if pathLight is None else pathLight)
+        mtime = os.path.getmtime(key)
+    except Exception as ex:
+        raise Exception(f'Unable to read SVG file "{path}", {ex}')
+    key = ( key, id ) if pathLight is None else ( key, id, "dark" )
+
+    if key in gTmpltCache and gTmpltCache[key][0] == mtime:
+        gTmpltCache.move_to_end(key)
+        return gTmpltCache[key][1:]
+
+    if pathLight is None:
+        elem = ReadSVGElement(path, id)
+    else:
+        elem = ReadSVGElementCached(pathLight, id)[0]
+        if elem is not None:
+            elem = copy.deepcopy(elem.getroot())
+            DeriveDarkSVG(elem, None)
+    if elem is None:
+        return ( None, { }, { } )
+    return CacheSVG(key, mtime, ET.ElementTree(elem))
+
+# ------------------------------------
+# index a parsed svg and add it to the template cache under the given key, evicting the least
+# recently used trees as necessary. returns an ( element tree, index, slots ) tuple as
+# ReadSVGCached() does.
+#
+def CacheSVG(key, mtime, xmlTree):
+    global gTmpltCache
+    global gTmpltCacheSize
+
+    index = IndexSVG(None, xmlTree.getroot(), { })
+    mapSlots = { }
+    if gTmpltCacheSize > 0:
+        Log(f"Caching parsed template {key}", level="debug")
+        gTmpltCache[key] = ( mtime, xmlTree, index, mapSlots )
+        gTmpltCache.move_to_end(key)
+        while len(gTmpltCache) > gTmpltCacheSize:
+            keyEvict, _ = gTmpltCache.popitem(last=False)
+            Log(f"Evicting parsed template {keyEvict}", level="debug")
+    return ( xmlTree, index, mapSlots )
+
+# ------------------------------------
+# read the first element (in document order) with the given (sanitized) id from the svg library
+# at the specified path without parsing the whole library. elements in the byte offset index of
+# the library (see IndexSVGOffsets()) are parsed on their own after seeking to them, others are
+# found with ExtractSVGElement(). returns the element, None if there is no such element (which is
+# known from the index without reading the library). raises an exception if there was an error.
+#
+def ReadSVGElement(path, id):
+    global gSVGOffsetCache
+
+    try:
+        key = os.path.realpath(path)
+        mtime = os.path.getmtime(key)
+        if key not in gSVGOffsetCache or gSVGOffsetCache[key][0] != mtime:
+            Log(f"Indexing element library {key}", level="debug")
+            gSVGOffsetCache[key] = ( mtime, IndexSVGOffsets(key) )
+        sizePrefix, tagRoot, index, ids = gSVGOffsetCache[key][1]
+        if id not in ids:
+            return None
+        elif id not in index:
+            return ExtractSVGElement(key, id)
+
+        # the element is parsed inside the start tag of the root (which carries the namespace
+        # declarations) so it comes out as it would from a parse of the whole library, tail and all.
+        start, end = index[id]
+        with open(key, "rb") as f:
+            xml = [ f.read(sizePrefix) ]
+            f.seek(start)
+            xml.append(f.read(end - start))
+        xml.append(f"</{tagRoot}>".encode("utf-8"))
+        return ET.fromstring(b"".join(xml))[0]
+    except Exception as ex:
+        raise Exception(f'Unable to read SVG file "{path}", {ex}')
+
+# ------------------------------------
+# build a byte offset index of the elements with ids within gSVGOffsetDepth levels of the root of
+# the svg at the specified path. this is a single streaming pass that does not build a tree. returns
+# a ( prefix size, root tag, index, ids ) tuple where the prefix is the text of the file through the
+# start tag of the root, index maps a sanitized id onto the ( start, end ) byte offsets of the
+# element, where the element runs through its tail, and ids is the set of the sanitized ids of all
+# elements in the svg. only the first element with an id is indexed, and elements under an element
+# (other than the root) that declares namespaces are not indexed as they cannot be parsed on their
+# own.
+#
+def IndexSVGOffsets(path):
+    global gSVGOffsetDepth
+
+    parser = xml.parsers.expat.ParserCreate()
+    index = { }
+    idsSeen = set()
+    stack = [ ]                         # ( children indexable, ( id, start ) if indexed ) per open element
+    spanEnded = None                    # ( id, start ) of an indexed element waiting on the end of its tail
+    sizePrefix = None
+    tagRoot = None
+
+    # every start and end tag closes the tail of the element ended before it.
+    def HandleTag():
+        nonlocal spanEnded
+        nonlocal sizePrefix
+        if spanEnded is not None:
+            index[spanEnded[0]] = ( spanEnded[1], parser.CurrentByteIndex )
+            spanEnded = None
+        if sizePrefix is None and len(stack) == 1:
+            sizePrefix = parser.CurrentByteIndex
+
+    def HandleStart(tag, attrs):
+        HandleTag()
+        isIndexable = len(stack) == 0 or stack[-1][0]
+        id = SanitizeKey(attrs.get("id"))
+        span = None
+        if id is not None and id not in idsSeen:
+            idsSeen.add(id)
+            if len(stack) > 0 and len(stack) <= gSVGOffsetDepth and isIndexable:
+                span = ( id, parser.CurrentByteIndex )
+        isDeclaring = len(stack) > 0 and any([ attr.startswith("xmlns") for attr in attrs ])
+        stack.append(( isIndexable and not isDeclaring, span ))
+
+    def HandleEnd(tag):
+        nonlocal spanEnded
+        nonlocal tagRoot
+        HandleTag()
+        spanEnded = stack.pop()[1]
+        if len(stack) == 0:
+            tagRoot = tag
+
+    parser.StartElementHandler = HandleStart
+    parser.EndElementHandler = HandleEnd
+    # feed the parser large blocks, ParseFile() uses small reads that are slow on the very long
+    # path data in element libraries.
+    with open(path, "rb") as f:
+        while True:
+            data = f.read(1 << 20)
+            parser.Parse(data, len(data) == 0)
+            if len(data) == 0:
+                break
+    return ( sizePrefix, tagRoot, index, idsSeen )
+
+# ------------------------------------
+# stream parse the svg at the specified path and return the first element (in document order)
+# with the given (sanitized) id, None if there is no such element. only the element, its
+# ancestors, and their unfinished children are held in memory and the parse stops once the
+# element (and its tail) is complete.
+#
+def ExtractSVGElement(path, id):
+    stack = [ ]
+    elemFound = None
+    isComplete = False
+    with open(path, "rb") as f:
+        for event, elem in ET.iterparse(f, events=( "start", "end" )):
+            if isComplete:
+                # any event after the end of the element means the parser has filled in its tail
+                break
+            elif event == "start":
+                if elemFound is None and SanitizeKey(elem.get("id")) == id:
+                    elemFound = elem
+                stack.append(elem)
+            else:
+                stack.pop()
+                if elem is elemFound:
+                    isComplete = True
+                elif elemFound is None and len(stack) > 0:
+                    # finished elements outside the element are not needed, drop them from their
+                    # parent to keep the partial tree small.
+                    stack[-1].remove(elem)
+    return elemFound
+
+# ------------------------------------
+# derive a dark template from the light template rooted at elem by remapping the fill and stroke
+# colors in the tree according to the gDarkRemap rules. if title is not None, it replaces the text
+# of the <title> of elem.
+#
+def DeriveDarkSVG(elem, title):
+    global gDarkRemap
+    global gDarkRemapIndex
+    global gSVGNS
+
+    if gDarkRemapIndex is None:
+        gDarkRemapIndex = { }
+        for tag, attr, colorLight, colorDark, id in gDarkRemap:
+            gDarkRemapIndex.setdefault(( tag, attr, colorLight ), [ ]).append(( id, colorDark ))
+
+    for child in elem.iter():
+        tag = child.tag.rpartition("}")[2]
+        for attr in ( "fill", "stroke" ):
+            color = child.get(attr)
+            if color is None:
+                continue
+            rules = gDarkRemapIndex.get(( tag, attr, color.upper() ), [ ]) + \
+                    gDarkRemapIndex.get(( None, attr, color.upper() ), [ ])
+            for id, colorDark in rules:
+                if id is None or id == SanitizeKey(child.get("id")):
+                    child.set(attr, colorDark)
+                    break
+
+    elemTitle = elem.find(f"{gSVGNS}title")
+    if title is not None and elemTitle is not None:
+        elemTitle.text = title
+
+# ------------------------------------
+# write the svg rooted at the given xml root to the specified path as utf-8 (the encoding ReadSVG()
+# decodes templates with), streaming the xml to the file. paths ending in ".svgz" are written gzip
+# compressed (with no timestamp so that identical svgs produce identical files). raises an
+# exception if there was an error.
 #
 def WriteSVG(path, xmlRoot):
     try:
-        with open(path, "w") as f:
-            for line in iter(ET.tostring(xmlRoot, encoding='unicode').splitlines()):
-                f.write(f"{line}\n")
+        if path.lower().endswith(".svgz"):
+            with open(path, "wb") as fb, gzip.GzipFile(fileobj=fb, mode="wb", mtime=0) as fz, \
+                 io.TextIOWrapper(fz, encoding="utf-8") as f:
+                ET.ElementTree(xmlRoot).write(f, encoding="unicode")
+                f.write("\n")
+        else:
+            with open(path, "w", encoding="utf-8") as f:
+                ET.ElementTree(xmlRoot).write(f, encoding="unicode")
+                f.write("\n")
     except Exception as ex:
         raise Exception(f'Unable to write SVG file "{path}", {ex}')
 
 # ------------------------------------
-# returns the first element found in the tree with the given id (this function recursively walks
-# the tree rooted at element), None if no element found.
+# minify the svg rooted at the given xml root for output: strips inkscape and sodipodi elements
+# and attributes, <metadata> elements, whitespace between elements (outside of text), and
+# elements in <defs> that are not referenced (through an href or url()) from the rest of the svg.
 #
-def SearchForIDInSVG(elem, id):
-    foundElem = elem
-    elemID = elem.get("id")
-    if elemID is None or elemID.lower() != id:
-        foundElem = None
-        for child in elem:
-            foundElem = SearchForIDInSVG(child, id)
-            if foundElem is not None:
-                break
-    return foundElem
+def MinifySVG(xmlRoot):
+    global gSVGNS
+
+    StripEditorInSVG(xmlRoot, False)
+
+    # find the defs referenced from outside of <defs>, then the defs those defs reference, and so on.
+    # defs without an id are always kept, so their references count as outside references.
+    defs = [ ( child, elemDefs ) for elemDefs in xmlRoot.iter(f"{gSVGNS}defs") for child in elemDefs
+             if child.get("id") is not None ]
+    defsByID = { }
+    for child, _ in defs:
+        defsByID.setdefault(child.get("id"), [ ]).append(child)
+    refs = CollectRefsInSVG(xmlRoot, set([ child for child, _ in defs ]), [ ])
+    idsUsed = set()
+    while len(refs) > 0:
+        id = refs.pop()
+        if id in defsByID and id not in idsUsed:
+            idsUsed.add(id)
+            for child in defsByID[id]:
+                CollectRefsInSVG(child, set(), refs)
+
+    for child, elemDefs in defs:
+        if child.get("id") not in idsUsed:
+            Log(f"Removing unused def {child.get('id')}", level="debug")
+            elemDefs.remove(child)
 
 # ------------------------------------
-# force the first element with the given id to appear at the top of the visual stack ("bring to
-# front") by recursively walking the tree rooted at the element. returns true when something is
-# moved, false if not.
+# strip editor data and whitespace between elements from the tree rooted at elem for MinifySVG().
+# isText is true if elem is within a text element, where whitespace and children are kept.
 #
-def ForceElemWithIDToFrontInSVG(parent, elem, id):
-    elemID = elem.get("id")
-    if elemID is not None and elemID == id:
-        Log(f"Bringing element {id} to front")
-        parent.remove(elem)
-        parent.append(elem)
-        return True
-    else:
-        for child in elem:
-            if ForceElemWithIDToFrontInSVG(elem, child, id):
-                return True
-    return False
+def StripEditorInSVG(elem, isText):
+    global gSVGNS
+    global gSVGEditorNS
+
+    for attr in [ attr for attr in elem.attrib if attr.startswith(gSVGEditorNS) ]:
+        del elem.attrib[attr]
+    isText = isText or elem.tag in ( f"{gSVGNS}text", f"{gSVGNS}flowRoot" )
+    if not isText and elem.text is not None and elem.text.isspace():
+        elem.text = None
+    for child in list(elem):
+        if not isText and (child.tag.startswith(gSVGEditorNS) or child.tag == f"{gSVGNS}metadata"):
+            elem.remove(child)
+            continue
+        StripEditorInSVG(child, isText)
+        if not isText and child.tail is not None and child.tail.isspace():
+            child.tail = None
+
+# ------------------------------------
+# add the ids referenced (through an href or url()) from the tree rooted at elem to refs, skipping
+# the subtrees rooted at the elements in skip. returns refs.
+#
+def CollectRefsInSVG(elem, skip, refs):
+    global gSVGNS
+    global gSVGURLRegex
+
+    if elem in skip:
+        return refs
+    for attr, value in elem.attrib.items():
+        if attr.endswith("href") and value.startswith("#"):
+            refs.append(value[1:])
+        elif "url(" in value:
+            refs.extend(gSVGURLRegex.findall(value))
+    if elem.tag == f"{gSVGNS}style" and elem.text is not None:
+        refs.extend(gSVGURLRegex.findall(elem.text))
+    for child in elem:
+        CollectRefsInSVG(child, skip, refs)
+    return refs
+
+# ------------------------------------
+# build an index of the elements with ids in the tree rooted at elem with a single walk. the index
+# is a dictionary that maps a sanitized id onto an array of ( element, parent ) tuples for the
+# elements with that id in document order. elements are added to the index passed in, which is
+# also returned.
+#
+def IndexSVG(parent, elem, index):
+    id = elem.get("id")
+    if id is not None:
+        index.setdefault(SanitizeKey(id), [ ]).append(( elem, parent ))
+    for child in elem:
+        IndexSVG(elem, child, index)
+    return index
+
+# ------------------------------------
+# returns the first element in the index with the given (sanitized) id, None if no element found.
+#
+def SearchForIDInSVG(index, id):
+    return index[id][0][0] if id in index else None
+
+# ------------------------------------
+# compile the tag slots in the tree rooted at elem with a single walk. a slot is an ( element,
+# parent, pieces ) tuple for an element with tags in its text, where pieces alternates between the
+# text around the tags and ( key, sanitized key, param ) tuples for the tags, starting and ending
+# with text. slots are appended to the array passed in (in document order), which is also returned.
+#
+def CompileSlotsInSVG(parent, elem, slots):
+    global gTagRegex
+
+    if elem.text and "#" in elem.text:
+        pieces = [ ]
+        iStart = 0
+        for match in gTagRegex.finditer(elem.text):
+            pieces.append(elem.text[iStart:match.start()])
+            pieces.append(( match.group(1), SanitizeKey(match.group(1)), match.group(2) ))
+            iStart = match.end()
+        if len(pieces) > 0:
+            pieces.append(elem.text[iStart:])
+            slots.append(( elem, parent, pieces ))
+    for child in elem:
+        CompileSlotsInSVG(elem, child, slots)
+    return slots
+
+# ------------------------------------
+# copy the subtree rooted at elem out of a shared tree from ReadSVGCached(). mapSlots maps the id()
+# of a subtree root onto the CompileSlotsInSVG() slots for the subtree, slots are compiled on first
+# use of a subtree and kept for later copies. returns a ( copy, slots ) tuple with the copy and its
+# slots for SubstituteInSVG(), the parent in the slot for the copy itself is None.
+#
+def CopyInSVG(elem, mapSlots):
+    if id(elem) not in mapSlots:
+        mapSlots[id(elem)] = CompileSlotsInSVG(None, elem, [ ])
+    memo = { }
+    elemCopy = copy.deepcopy(elem, memo)
+    slots = [ ( memo[id(slotElem)], None if slotParent is None else memo[id(slotParent)], pieces )
+              for slotElem, slotParent, pieces in mapSlots[id(elem)] ]
+    return ( elemCopy, slots )
 
 # ------------------------------------
 # TODO
@@ -410,101 +1180,300 @@ def ApplyParamInSVG(parent, elem, param, sub):
                     elem.set("kbb_y", str(y[index] +  ((nSpans - len(lines)) / 2) * (y[1] - y[0])))
                         
         else:
-            Log(f"Skipping unknown field \"{field[0]}\" in parameter \"{param}\"")
+            Log(f"Skipping unknown field \"{field[0]}\" in parameter \"{param}\"", level="warn")
     return sub
 
 # ------------------------------------
-# replace tags in text attributes of an element and its children according to a substitution map.
+# replace tags in the text of the elements in the slots from CopyInSVG() according to a substitution
+# map. only elements with tags are visited, tags without a substitution are cleared.
 #
-def SubstituteInSVG(parent, elem, mapSub):
-    global gTagRegex
-
-    if elem.text:
-        for match in gTagRegex.finditer(elem.text):
-            key = match.group(1)
-            param = match.group(2)
-            keySanitized = SanitizeKey(key)
-            keyRebake = f"#{key}#" if len(param) == 0 else f"#{key};{param}#"
+def SubstituteInSVG(slots, mapSub):
+    for elem, parent, pieces in slots:
+        text = [ pieces[0] ]
+        for iPiece in range(1, len(pieces), 2):
+            key, keySanitized, param = pieces[iPiece]
             if keySanitized in mapSub:
-                Log(f"{key} <-- {mapSub[keySanitized]}, param: \"{param}\"")
+                Log(f"{key} <-- {mapSub[keySanitized]}, param: \"{param}\"", level="debug")
                 sub = mapSub[keySanitized]
                 if len(param) > 0:
                     sub = ApplyParamInSVG(parent, elem, param, sub)
-                elem.text = elem.text.replace(keyRebake, sub)
+                text.append(sub)
             else:
-                Log(f"{key} <-- <clear>")
-                elem.text = elem.text.replace(keyRebake, "")
-    for child in elem:
-        SubstituteInSVG(elem, child, mapSub)
+                Log(f"{key} <-- <clear>", level="debug")
+            text.append(pieces[iPiece + 1])
+        elem.text = "".join(text)
 
 # ------------------------------------
-# replace according to the replacement map working through the tree rooted at elem. returns the
-# replacement element added in place of this element if a replacement was necessary. a return
-# value of elem indicates the element should be removed.
+# build the element that replaces elem according to the replacement map entry ( <src_id>, <path>,
+# <sm> ). returns a ( replacement, front ) tuple where replacement is the replacement element (elem
+# if the element should be removed) and front is as EditInSVG() returns for the replacement.
 #
-def ReplaceInSVG(parent, elem, mapRep, pathTmplts):
+def BuildReplacementInSVG(elem, repEntry, idFront):
     id = elem.get("id")
-    idSanitized = SanitizeKey(id)
-    if idSanitized in mapRep and parent is not None:
-        idSrc, path, mapSub = mapRep[idSanitized]
-        if idSrc is None:
-            # rep map indicates element should be removed, return elem.
-            Log(f"{elem.tag} id={id} <-- <remove>")
-            elemAdd = elem
-        else:
-            # rep map indicates elements should be replaced, return added element
-            Log(f"{elem.tag} id={id} <-- {mapRep[idSanitized]}")
-            try:
-                tPath = FindTemplate(path)
-                if tPath is None:
-                    raise Exception(f"Unable to find template \"{path}\"")
-                if idSrc[:4].lower() == ".png":
-                    xmlTree = ReadPNG(tPath, idSrc)
-                    idSrc = ".png"
-                else:
-                    xmlTree = ReadSVG(tPath)
-            except Exception as ex:
-                raise ex
-            else:
-                # search template .svg file for element matching <src_id> from rep map. if
-                # found, do substitutions and translate it to the location of the element
-                # being replaced.
-                elemAdd = SearchForIDInSVG(xmlTree.getroot(), idSrc)
-                if elemAdd is None:
-                    raise Exception(f"TODO: ERROR, elem not found? {idSrc}")
-                else:
-                    SubstituteInSVG(None, elemAdd, mapSub)
-                    x = "0.0" if elem.get("x") is None else elem.get("x")
-                    y = "0.0" if elem.get("y") is None else elem.get("y")
-                    elemAdd.set("transform", f"translate({x}, {y})")
-        return elemAdd
+    idSrc, path, mapSub = repEntry
+    if idSrc is None:
+        # rep map indicates element should be removed, return elem.
+        Log(f"{elem.tag} id={id} <-- <remove>")
+        return ( elem, None )
 
+    # rep map indicates elements should be replaced, return added element
+    Log(f"{elem.tag} id={id} <-- {repEntry}")
+    tPath = FindTemplate(path)
+    if tPath is None:
+        raise Exception(f"Unable to find template \"{path}\"")
+    if idSrc[:4].lower() == ".png":
+        xmlTree, index, mapSlots = ReadPNGCached(tPath, idSrc)
+        idSrc = ".png"
     else:
-        elemsUpdate = [ ]
-        for child in elem:
-            elemAdd = ReplaceInSVG(elem, child, mapRep, pathTmplts)
-            if elemAdd is child:
-                elemsUpdate.append(( None, child ))
-            elif elemAdd is not None:
-                elemsUpdate.append(( elemAdd, child ))
-        for elemTupleAD in elemsUpdate:
-            if elemTupleAD[0] is not None:
-                elem.append(elemTupleAD[0])
-            elem.remove(elemTupleAD[1])
+        xmlTree, index, mapSlots = ReadSVGElementCached(tPath, idSrc)
 
-    return None
+    # search template .svg file for element matching <src_id> from rep map. if found, copy it out
+    # of the (shared) template, do substitutions, and translate it to the location of the element
+    # being replaced.
+    elemAdd = SearchForIDInSVG(index, idSrc)
+    if elemAdd is None:
+        raise Exception(f"TODO: ERROR, elem not found? {idSrc}")
+    elemAdd, slots = CopyInSVG(elemAdd, mapSlots)
+    SubstituteInSVG(slots, mapSub)
+    front = EditInSVG(elemAdd, None, idFront)
+    x = "0.0" if elem.get("x") is None else elem.get("x")
+    y = "0.0" if elem.get("y") is None else elem.get("y")
+    elemAdd.set("transform", f"translate({x}, {y})")
+    return ( elemAdd, front )
 
 # ------------------------------------
-# update the coordiantes in the svg tree by copying kbb_x and kbb_y to x and y, respectively.
-# recurse through the children.
+# update the coordinates of an element by copying kbb_x and kbb_y to x and y, respectively.
 #
-def FinalizeCoordsInSVG(parent, elem):
+def FinalizeCoordsInSVG(elem):
     if elem.get("kbb_x", default=None) is not None:
         elem.set("x", elem.get("kbb_x"))
     if elem.get("kbb_y", default=None) is not None:
         elem.set("y", elem.get("kbb_y"))
+
+# ------------------------------------
+# apply edits to the children of elem (and, recursively, their children) in a single walk. this
+# replaces (or removes) elements according to the replacement map (which may be None) and finalizes
+# coordinates. the caller is responsible for substituting tags in the tree with SubstituteInSVG()
+# before, and finalizing the coordinates of elem after, the walk.
+#
+# edits are applied in the same order as separate replace and finalize passes would apply them:
+# replacement elements are appended to the parent of the element they replace (in the order of the
+# replaced elements) and coordinates are only finalized once all tags have been substituted (as
+# multiline parameters look at the coordinates of sibling elements).
+#
+# returns a ( element, parent ) tuple for the first element in the edited tree (in document order)
+# with id idFront, None if there is no such element. elem itself is not considered.
+#
+def EditInSVG(elem, mapRep, idFront):
+    front = None
+    elemsUpdate = [ ]
     for child in elem:
-        FinalizeCoordsInSVG(elem, child)
+        if mapRep is not None and SanitizeKey(child.get("id")) in mapRep:
+            elemAdd, frontAdd = BuildReplacementInSVG(child, mapRep[SanitizeKey(child.get("id"))], idFront)
+            elemsUpdate.append(( elemAdd, frontAdd, child ))
+        else:
+            frontChild = EditInSVG(child, mapRep, idFront)
+            if front is None and idFront is not None and child.get("id") == idFront:
+                front = ( child, elem )
+            elif front is None:
+                front = frontChild
+
+    for elemAdd, frontAdd, child in elemsUpdate:
+        if elemAdd is not child:
+            elem.append(elemAdd)
+            if front is None and idFront is not None and elemAdd.get("id") == idFront:
+                front = ( elemAdd, elem )
+            elif front is None:
+                front = frontAdd
+        elem.remove(child)
+
+    for child in elem:
+        FinalizeCoordsInSVG(child)
+    return front
+
+# -------------------------------------------------------------------------------------------------
+#
+# png rasterization
+#
+# -------------------------------------------------------------------------------------------------
+
+# rasterizers convert output .svg files to .png files. a rasterizer has an isInMemory attribute
+# and two methods,
+#
+#     Submit(pathSVG, pathPNG, isKeepSVG)  queue conversion of the .svg at pathSVG to a .png at
+#                                          pathPNG, the .svg is removed once converted unless
+#                                          isKeepSVG is true
+#     Finish()                             wait for all submitted conversions to complete and
+#                                          release any resources
+#
+# conversions may complete asynchronously any time between Submit() and Finish(). rasterizers
+# with a true isInMemory attribute also have a method,
+#
+#     Render(xmlRoot, pathPNG)             convert the svg rooted at xmlRoot to a .png at pathPNG
+#
+# that converts an svg held in memory before returning. these rasterizers run in the process that
+# builds the svg (including worker processes) and do not need an .svg file. methods raise an
+# exception on error.
+
+# ------------------------------------
+# rasterizer that runs a new inkscape process for each conversion as it is submitted.
+#
+class InkscapeRasterizer:
+    isInMemory = False
+
+    def Submit(self, pathSVG, pathPNG, isKeepSVG):
+        global gInkscape
+
+        output = check_output(f"{gInkscape} --export-filename={pathPNG} {pathSVG}", shell=True).decode()
+        Log(output)
+        if not isKeepSVG:
+            Log(f"Removing intermediate SVG file, {pathSVG}", True)
+            os.remove(pathSVG)
+
+    def Finish(self):
+        pass
+
+# ------------------------------------
+# rasterizer that streams conversions through long-lived inkscape processes running in "--shell"
+# mode to avoid paying inkscape startup costs for each conversion. conversions are distributed
+# round-robin over up to nSessions processes and run while later .svg files are being built. as
+# the shell does not report failed exports through its exit status, Finish() checks that each
+# submitted .png was written after it was submitted.
+#
+class InkscapeShellRasterizer:
+    isInMemory = False
+
+    def __init__(self, nSessions=1):
+        self.nSessions = max(nSessions, 1)
+        self.sessions = [ ]                                     # ( process, reader, output ) tuples
+        self.iNext = 0
+        self.pathsRemove = [ ]
+        self.pngsExpected = [ ]                                 # ( .png path, submit time ) tuples
+
+    # start an inkscape shell session. a thread drains the session's output so that inkscape does
+    # not block writing to a full pipe.
+    #
+    def StartSession(self):
+        global gInkscape
+
+        Log(f"Starting {gInkscape} shell session {len(self.sessions) + 1}")
+        try:
+            process = subprocess.Popen([ gInkscape, "--shell" ], stdin=subprocess.PIPE,
+                                       stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        except Exception as ex:
+            raise Exception(f"Unable to start {gInkscape} shell, {ex}")
+        output = [ ]
+        reader = threading.Thread(target=lambda: output.extend(process.stdout), daemon=True)
+        reader.start()
+        self.sessions.append(( process, reader, output ))
+
+    def Submit(self, pathSVG, pathPNG, isKeepSVG):
+        if len(self.sessions) < self.nSessions:
+            self.StartSession()
+        process = self.sessions[self.iNext % len(self.sessions)][0]
+        self.iNext += 1
+
+        pathSVG = os.path.abspath(pathSVG)
+        pathPNG = os.path.abspath(pathPNG)
+        self.pngsExpected.append(( pathPNG, time.time() ))
+        try:
+            process.stdin.write(f"file-open:{pathSVG}; export-filename:{pathPNG}; export-do; file-close\n")
+            process.stdin.flush()
+        except Exception as ex:
+            raise Exception(f"Unable to send {pathSVG} to {gInkscape} shell, {ex}")
+        if not isKeepSVG:
+            self.pathsRemove.append(pathSVG)
+
+    def Finish(self):
+        for process, reader, output in self.sessions:
+            try:
+                process.stdin.write("quit\n")
+                process.stdin.close()
+            except Exception:
+                pass
+            process.wait()
+            reader.join()
+            Log("".join(output))
+        failed = [ p.returncode for p, _, _ in self.sessions if p.returncode != 0 ]
+        outputs = [ "".join(output) for _, _, output in self.sessions ]
+        self.sessions = [ ]
+
+        # allow for file systems with coarse timestamps when checking the .png files are new.
+        missing = [ ]
+        for pathPNG, tSubmit in self.pngsExpected:
+            if not os.path.exists(pathPNG) or os.path.getmtime(pathPNG) < tSubmit - 2.0:
+                missing.append(pathPNG)
+        self.pngsExpected = [ ]
+
+        for pathSVG in self.pathsRemove:
+            Log(f"Removing intermediate SVG file, {pathSVG}", True)
+            os.remove(pathSVG)
+        self.pathsRemove = [ ]
+        if len(failed) > 0:
+            raise Exception(f"{gInkscape} shell exited with status {failed[0]}")
+        if len(missing) > 0:
+            for output in outputs:
+                Log(output, True, level="error")
+            raise Exception(f"{gInkscape} shell did not create {', '.join(missing)}")
+
+# ------------------------------------
+# rasterizer that records conversions without producing any .png files, for testing.
+#
+class StubRasterizer:
+    isInMemory = False
+
+    def __init__(self):
+        self.conversions = [ ]
+
+    def Submit(self, pathSVG, pathPNG, isKeepSVG):
+        Log(f"Stub rasterizer skipping conversion of {pathSVG} to {pathPNG}")
+        self.conversions.append(( pathSVG, pathPNG, isKeepSVG ))
+        if not isKeepSVG:
+            Log(f"Removing intermediate SVG file, {pathSVG}", True)
+            os.remove(pathSVG)
+
+    def Finish(self):
+        pass
+
+# ------------------------------------
+# rasterizer that converts in-process with the (optional) cairosvg package, no inkscape required.
+#
+class CairoRasterizer:
+    isInMemory = True
+
+    def __init__(self):
+        try:
+            import cairosvg
+        except (ImportError, OSError) as ex:
+            raise Exception(f"Renderer \"cairosvg\" requires the cairosvg package and cairo library, {ex}")
+        self.cairosvg = cairosvg
+
+    def Submit(self, pathSVG, pathPNG, isKeepSVG):
+        self.cairosvg.svg2png(url=pathSVG, write_to=pathPNG)
+        if not isKeepSVG:
+            Log(f"Removing intermediate SVG file, {pathSVG}", True)
+            os.remove(pathSVG)
+
+    def Render(self, xmlRoot, pathPNG):
+        self.cairosvg.svg2png(bytestring=ET.tostring(xmlRoot, encoding="utf-8"), write_to=pathPNG)
+
+    def Finish(self):
+        pass
+
+# ------------------------------------
+# returns a new rasterizer for the given renderer name ("shell", "inkscape", "cairosvg", or "stub").
+# nSessions is a hint for the number of conversions that may run in parallel.
+#
+def NewRasterizer(renderer, nSessions=1):
+    if renderer == "shell":
+        return InkscapeShellRasterizer(nSessions)
+    elif renderer == "inkscape":
+        return InkscapeRasterizer()
+    elif renderer == "cairosvg":
+        return CairoRasterizer()
+    elif renderer == "stub":
+        return StubRasterizer()
+    raise Exception(f"Unknown renderer \"{renderer}\"")
 
 # -------------------------------------------------------------------------------------------------
 #
@@ -554,7 +1523,7 @@ def ParseGroup(group, flight, iColVariant, search):
                 if mapKey not in mapSub:
                     mapSub[mapKey] = value
                 else:
-                    Log(f"Skipping repeated field \"{field}\" in {flight} flight, line {rowNum}", True)
+                    Log(f"Skipping repeated field \"{field}\" in {flight} flight, line {rowNum}", True, level="warn")
             elif len(match.groups()) == 2:
                 dstID = SanitizeKey(match.group(1))
                 key = SanitizeKey(match.group(2))
@@ -575,7 +1544,7 @@ def ParseGroup(group, flight, iColVariant, search):
                         col = matchCoord.group(2)
                         lastCol = int(col)
                     dstID = SanitizeKey(f"R {row} C {col}")
-                    Log(f"Remaps coordinate {match.group(1)} --> {dstID}")
+                    Log(f"Remaps coordinate {match.group(1)} --> {dstID}", level="debug")
 
                 if key == SanitizeKey("Replace") and len(dstID) > 0:
                     # has ":" and "Replace": rep map entry, sanitize <src_id>, <dst_id>
@@ -591,9 +1560,9 @@ def ParseGroup(group, flight, iColVariant, search):
                         mapRep[dstID] = ( srcID, path, { } )
                         lastReplaceID = dstID
                     else:
-                        Log(f"Skipping field \"{field}\" with parse error in {flight} flight, line {rowNum}", True)
+                        Log(f"Skipping field \"{field}\" with parse error in {flight} flight, line {rowNum}", True, level="warn")
                 elif key == SanitizeKey("Replace") and len(dstID) == 0:
-                    Log(f"Replace missing ID in {flight} flight, line {rowNum}", True)
+                    Log(f"Replace missing ID in {flight} flight, line {rowNum}", True, level="warn")
                 else:
                     if len(dstID) == 0:
                         dstID = lastReplaceID
@@ -611,48 +1580,219 @@ def ParseGroup(group, flight, iColVariant, search):
                                 # has ":" and key: rep map sub map entry, sanitize <src_id>, <dst_id>
                                 mapRep[dstID][2][key] = value
                             elif dstID in mapRep:
-                                Log(f"Skipping repeated field \"{key}\" in {flight} flight, line {rowNum}", True)
+                                Log(f"Skipping repeated field \"{key}\" in {flight} flight, line {rowNum}", True, level="warn")
                             else:
-                                Log(f"Unknown ID \"{dstID}\" in {flight} flight, line {rowNum}", True)    
+                                Log(f"Unknown ID \"{dstID}\" in {flight} flight, line {rowNum}", True, level="warn")    
                     else:
-                        Log(f"Skipping unbalanced ';' field \"{key}\" in {flight} flight, line {rowNum}", True)
+                        Log(f"Skipping unbalanced ';' field \"{key}\" in {flight} flight, line {rowNum}", True, level="warn")
             else:
-                Log(f"Skipping field \"{field}\" with parse error in {flight} flight, line {rowNum}", True)
+                Log(f"Skipping field \"{field}\" with parse error in {flight} flight, line {rowNum}", True, level="warn")
 
     return ( pathTmpl, pathOutBase, isNight, mapSub, mapRep )
 
 # ------------------------------------
-# TODO
+# build the output .svg for a variant. in-memory rasterizers create the .png here, writing the .svg
+# only if it is to be kept. returns a ( .svg path, .png path, keep .svg ) tuple with the arguments
+# for the rasterizer Submit() method if a .png still needs to be created, None otherwise.
 #
 def BuildOutputFiles(pathTmpl, mapSub, mapRep, pathOutBase, isSVG, isPNG):
+    global gRasterizer
+    global gSVGMinify
+    global gSVGCompress
+
+    tStart = time.time()
     Log(f"Applying edits to SVG template, {pathTmpl}", True)
-    xmlTree = ReadSVG(pathTmpl)
+    xmlTree, _, mapSlots = ReadSVGCached(pathTmpl)
+    xmlRoot, slots = CopyInSVG(xmlTree.getroot(), mapSlots)
+    xmlTree = ET.ElementTree(xmlRoot)
     # TODO: handle SVG read failure?
 
-    SubstituteInSVG(None, xmlTree.getroot(), mapSub)
-    ReplaceInSVG(None, xmlTree.getroot(), mapRep, None)
-    FinalizeCoordsInSVG(None, xmlTree.getroot())
-    ForceElemWithIDToFrontInSVG(None, xmlTree.getroot(), "Night-Tint")
+    # fill the tag slots, apply the replacements in one walk, then bring the night tint (if it was
+    # not removed) to the front.
+    SubstituteInSVG(slots, mapSub)
+    front = EditInSVG(xmlTree.getroot(), mapRep, "Night-Tint")
+    FinalizeCoordsInSVG(xmlTree.getroot())
+    if front is not None:
+        Log(f"Bringing element {front[0].get('id')} to front")
+        front[1].remove(front[0])
+        front[1].append(front[0])
 
     # TODO update xml ids carrying the template name with the output name?
 
-    pathOutSVG = f"{pathOutBase}.svg"
-    Log(f"Creating new SVG file with edits applied, {pathOutSVG}", True)
-    WriteSVG(pathOutSVG, xmlTree.getroot())
+    pathOutSVG = f"{pathOutBase}.svgz" if gSVGCompress else f"{pathOutBase}.svg"
+    if isSVG or not isPNG or not gRasterizer.isInMemory:
+        if gSVGMinify:
+            MinifySVG(xmlTree.getroot())
+        Log(f"Creating new SVG file with edits applied, {pathOutSVG}", True)
+        WriteSVG(pathOutSVG, xmlTree.getroot())
 
-    if isPNG:
+    if isPNG and gRasterizer.isInMemory:
         pathOutPNG = f"{pathOutBase}.png"
+        Log(f"Rendering SVG to PNG, {pathOutPNG}", True)
+        gRasterizer.Render(xmlTree.getroot(), pathOutPNG)
+
+    tBuild = time.time() - tStart
+    Log(f"Built {pathOutBase} in {tBuild:.3f}s", seconds=round(tBuild, 3))
+
+    if isPNG and not gRasterizer.isInMemory:
+        return ( pathOutSVG, f"{pathOutBase}.png", isSVG )
+    return None
+
+# ------------------------------------
+# hand the conversion from BuildOutputFiles() to the rasterizer, if there is one.
+#
+def RasterizeOutputFiles(conversion):
+    global gRasterizer
+
+    if conversion is not None:
+        pathOutSVG, pathOutPNG, isKeepSVG = conversion
         Log(f"Converting SVG file to PNG, {pathOutPNG}", True)
-        output = check_output(f"inkscape.com --export-filename={pathOutPNG} {pathOutSVG}", shell=True).decode()
-        Log(output)
-    if not isSVG:
-        Log(f"Removing intermediate SVG file, {pathOutSVG}", True)
-        os.remove(pathOutSVG)
+        gRasterizer.Submit(pathOutSVG, pathOutPNG, isKeepSVG)
 
 # ------------------------------------
-# TODO
+# read the build manifest from the output directory. returns the manifest, an empty manifest if
+# there is no manifest or it cannot be read.
 #
-def BuildGroup(args, group):
+def ReadManifest(pathOut):
+    global gManifestFile
+
+    path = os.path.join(pathOut, gManifestFile)
+    try:
+        with open(path, "r") as f:
+            manifest = json.load(f)
+        if not isinstance(manifest, dict):
+            raise Exception("Manifest is not an object")
+    except Exception as ex:
+        if os.path.exists(path):
+            Log(f"Ignoring unreadable build manifest {path}, {ex}", level="warn")
+        manifest = { }
+    return manifest
+
+# ------------------------------------
+# write the build manifest to the output directory. raises an exception if there was an error.
+#
+def WriteManifest(pathOut, manifest):
+    global gManifestFile
+
+    path = os.path.join(pathOut, gManifestFile)
+    try:
+        with open(path, "w") as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+    except Exception as ex:
+        raise Exception(f'Unable to write build manifest "{path}", {ex}')
+
+# ------------------------------------
+# returns a stamp identifying the current state of the file at path for HashVariant(), None if
+# path is None or does not exist. derived dark templates are stamped by their light template along
+# with a digest of the gDarkRemap rules they are derived with.
+#
+def StampFile(path):
+    global gDarkRemap
+
+    pathLight = FindDarkSource(path) if path is not None else None
+    if pathLight is not None:
+        stat = os.stat(pathLight)
+        digest = hashlib.sha256(json.dumps(gDarkRemap).encode("utf-8")).hexdigest()
+        return [ os.path.realpath(pathLight), stat.st_mtime_ns, stat.st_size, "dark", digest ]
+    if path is None or not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    return [ os.path.realpath(path), stat.st_mtime_ns, stat.st_size ]
+
+# ------------------------------------
+# returns a hash of the inputs used to build a variant: the sub and rep maps from ParseGroup(), the
+# template and replacement source files (by path, mtime, and size), the tint, the kbb version, and
+# the output options. a variant whose hash matches its manifest entry does not need to be rebuilt.
+#
+def HashVariant(args, pathTmpl, isNight, mapSub, mapRep):
+    global gVersion
+
+    inputs = {
+        "version" : gVersion,
+        "template" : StampFile(pathTmpl),
+        "night" : isNight,
+        "subs" : mapSub,
+        "reps" : { dstID : [ rep[0], StampFile(rep[1]), rep[2] ] for dstID, rep in mapRep.items() },
+        "output" : [ args.svg, not args.nopng, args.renderer, args.minify, args.svgz, args.resample, args.dark ]
+    }
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode("utf-8")).hexdigest()
+
+# ------------------------------------
+# returns true if the outputs for a variant are up to date with respect to the manifest: the
+# manifest hash matches and the output files exist.
+#
+def IsVariantCurrent(args, pathOutBase, digest):
+    global gManifest
+
+    key = os.path.relpath(pathOutBase, args.output)
+    if gManifest is None or gManifest.get(key) != digest:
+        return False
+    if not args.nopng and not os.path.exists(f"{pathOutBase}.png"):
+        return False
+    if args.svg and not os.path.exists(f"{pathOutBase}.svgz" if args.svgz else f"{pathOutBase}.svg"):
+        return False
+    return True
+
+# ------------------------------------
+# set up the globals in a worker process used to build output files to match the main process.
+#
+def InitBuildWorker(logFile, logLevel, tmpltSearch, tmpltCacheSize, tmpltDark, svgMinify, svgCompress, pngResample,
+                    renderer):
+    global gLogFile
+    global gLogLevel
+    global gTmpltSearch
+    global gTmpltCacheSize
+    global gTmpltDark
+    global gSVGMinify
+    global gSVGCompress
+    global gPNGResample
+    global gRasterizer
+
+    gLogFile = logFile
+    gLogLevel = logLevel
+    gTmpltSearch = tmpltSearch
+    gTmpltCacheSize = tmpltCacheSize
+    gTmpltDark = tmpltDark
+    gSVGMinify = svgMinify
+    gSVGCompress = svgCompress
+    gPNGResample = pngResample
+    gRasterizer = NewRasterizer(renderer)
+
+# ------------------------------------
+# build the output files for a variant in a worker process. job is a tuple with the arguments to
+# BuildOutputFiles() preceeded by the log context and the variant's flight name. returns a ( log,
+# conversion, exception ) tuple where log is an array of ( record, echo ) tuples from Log() for the
+# job (see WriteLog()), conversion is the
+# return value from BuildOutputFiles(), and exception is the exception raised by the job (None if
+# the job was successful).
+#
+def BuildOutputFilesJob(job):
+    global gLogBuffer
+    global gLogContext
+
+    gLogBuffer = [ ]
+    try:
+        gLogContext, flight, pathTmpl, mapSub, mapRep, pathOutBase, isSVG, isPNG = job
+        Log(f'\nBuilding {flight} flight kneeboard from "{pathTmpl}", output "{pathOutBase}"', True)
+        conversion = BuildOutputFiles(pathTmpl, mapSub, mapRep, pathOutBase, isSVG, isPNG)
+        err = None
+    except Exception as ex:
+        conversion = None
+        err = ex
+    log = gLogBuffer
+    gLogBuffer = None
+    return ( log, conversion, err )
+
+# ------------------------------------
+# build the variants in a group. if pool is None, the variants are built in order before returning.
+# otherwise, the variants are submitted to the pool as BuildOutputFilesJob() jobs and an array of
+# futures for the jobs (in variant order) is returned.
+#
+def BuildGroup(args, group, pool=None):
+    global gManifest
+    global gLogContext
+
+    futures = [ ]
     headerCols = group[0][1]
     for iColVariant in range(2, len(headerCols)):
         # first empty variant column indicates no more variants, break out of loop as we're done. consider
@@ -660,6 +1800,7 @@ def BuildGroup(args, group):
         flight = headerCols[iColVariant]
         if len(flight) == 0:
             break
+        gLogContext = { **gLogContext, "flight" : flight }
 
         pathTmpl, pathOutBase, isNight, mapSub, mapRep = ParseGroup(group, flight, iColVariant, args.search)
         
@@ -676,29 +1817,106 @@ def BuildGroup(args, group):
         if args.log:
             Log(f"Subs {mapSub}")
             Log(f"Reps {mapRep}")
-        if not args.dry:
+
+        # skip variants whose inputs have not changed since they were last built. the manifest is
+        # updated as variants are built, but only written once the build completes.
+        if not args.dry and gManifest is not None:
+            digest = HashVariant(args, pathTmpl, (isNight or args.night) and not args.day, mapSub, mapRep)
+            if not args.force and IsVariantCurrent(args, pathOutBase, digest):
+                Log(f'\nSkipping {flight} flight kneeboard, output "{pathOutBase}" is up to date', True)
+                continue
+            gManifest[os.path.relpath(pathOutBase, args.output)] = digest
+
+        if not args.dry and pool is not None:
+            job = ( gLogContext, flight, pathTmpl, mapSub, mapRep, pathOutBase, args.svg, not args.nopng )
+            futures.append(pool.submit(BuildOutputFilesJob, job))
+        elif not args.dry:
             Log(f'\nBuilding {flight} flight kneeboard from "{pathTmpl}", output "{pathOutBase}"', True)
-            BuildOutputFiles(pathTmpl, mapSub, mapRep, pathOutBase, args.svg, not args.nopng)
+            RasterizeOutputFiles(BuildOutputFiles(pathTmpl, mapSub, mapRep, pathOutBase, args.svg, not args.nopng))
+
+    return futures
+
+# ------------------------------------
+# build the groups from a definition, using args.jobs worker processes to build variants in
+# parallel when args.jobs > 1. the log from each job is output as a unit once the job completes
+# with jobs reported (and their .png files rasterized) in definition order. raises an exception on
+# error.
+#
+def BuildGroups(args, groups):
+    global gLogFile
+    global gLogLevel
+    global gLogContext
+    global gTmpltSearch
+    global gTmpltCacheSize
+    global gTmpltDark
+    global gSVGMinify
+    global gSVGCompress
+    global gPNGResample
+
+    if args.jobs <= 1:
+        for iGroup, group in enumerate(groups):
+            gLogContext = { "group" : iGroup }
+            BuildGroup(args, group)
+        gLogContext = { }
+        return
+
+    initArgs = ( gLogFile, gLogLevel, gTmpltSearch, gTmpltCacheSize, gTmpltDark, gSVGMinify, gSVGCompress,
+                 gPNGResample, args.renderer )
+    with ProcessPoolExecutor(max_workers=args.jobs, initializer=InitBuildWorker, initargs=initArgs) as pool:
+        futures = [ ]
+        for iGroup, group in enumerate(groups):
+            gLogContext = { "group" : iGroup }
+            futures.extend(BuildGroup(args, group, pool))
+        gLogContext = { }
+        for future in futures:
+            log, conversion, err = future.result()
+            for record, isEcho in log:
+                WriteLog(record, isEcho)
+            if err is not None:
+                pool.shutdown(cancel_futures=True)
+                raise err
+            RasterizeOutputFiles(conversion)
 
 # ------------------------------------
 # main, just like it says...
 #
 def main():
     global gLogFile
+    global gLogLevels
+    global gLogLevel
     global gTmpltSearch
+    global gTmpltCacheSize
+    global gSVGMinify
+    global gSVGCompress
+    global gPNGResample
+    global gTmpltDark
+    global gRasterizer
+    global gManifest
 
     parser = argparse.ArgumentParser(description="Build kneeboard from descriptions and templates")
     parser.add_argument("--log", action="store_true", help="Generate logging information on template edits to kbb_log.txt")
+    parser.add_argument("--loglevel", default="debug", choices=[ "debug", "info", "warn", "error" ], help="Minimum level of messages to log with --log (default: debug)")
+    parser.add_argument("--logjson", action="store_true", help="Log json records with group, flight, and timing fields to kbb_log.jsonl (implies --log)")
     parser.add_argument("--dry", action="store_true", help="Dry run, do not produce any output files")
     parser.add_argument("--svg", action="store_true", help="Preserve .svg intermediate files when creating .png files")
     parser.add_argument("--day", action="store_true", help="Force day tint, regardless of definition file (mutually exclusive with --night)")
     parser.add_argument("--night", action="store_true", help="Force night tint, regardless of definition file (mutually exclusive with --day)")
+    parser.add_argument("--minify", action="store_true", help="Strip editor data, unused defs, and whitespace from output .svg files")
+    parser.add_argument("--svgz", action="store_true", help="Write output .svg files gzip compressed, as .svgz files")
+    parser.add_argument("--resample", action="store_true", help="Downsample .png replacements larger than their slot before embedding (requires pillow)")
+    parser.add_argument("--dark", action="store_true", help="Use dark (_Dk) variants of templates, deriving them from light templates if there is no _Dk file")
     parser.add_argument("--nopng", action="store_true", help="Do not create .png files (implies --svg)")
     parser.add_argument("--edits", action="store_true", help="Definition argument is a KBB edits file file to process (requires --template)")
     parser.add_argument("--search", default=[], action="append", help="Additional search path for template files (optional, can be repeated)")
     parser.add_argument("--output", type=str, default=".", help="Path save output files to (default: current directory)")
     parser.add_argument("--template", default=None, help="Path to template .svg file (--edits only)")
-    parser.add_argument("definition", help="Definition file: CSV by default, KBB edits file if --edits given")
+    parser.add_argument("--renderer", default="shell", choices=[ "shell", "inkscape", "cairosvg", "stub" ],
+                        help="PNG renderer: persistent Inkscape shell, Inkscape per file, in-process cairosvg, or stub (default: shell)")
+    parser.add_argument("--force", action="store_true", help="Rebuild all kneeboards, even those whose inputs have not changed since the last build")
+    parser.add_argument("--jobs", type=int, default=1, help="Number of kneeboards to build in parallel (default: 1)")
+    parser.add_argument("--cache", type=int, default=8, help="Maximum number of parsed templates to cache (default: 8, 0 disables)")
+    parser.add_argument("--sheet", default=[], action="append", help="Worksheet to read from an .xlsx definition (optional, can be repeated, default: all)")
+    parser.add_argument("definition", help="Definition file: CSV or XLSX by default, KBB edits file if --edits given")
     args = parser.parse_args()
 
     # TODO should implement simple search path for templates: ".", then "./templates", then --templates
@@ -717,10 +1935,19 @@ def main():
         exit(-1)
     if args.nopng:
         args.svg = True
+    gTmpltCacheSize = max(args.cache, 0)
+    gSVGMinify = args.minify
+    gSVGCompress = args.svgz
+    gPNGResample = args.resample
+    gTmpltDark = args.dark
 
-    if args.log and os.path.exists(gLogFile):
-        os.remove(gLogFile)
-    elif not args.log:
+    if args.logjson:
+        args.log = True
+        gLogFile = os.path.splitext(gLogFile)[0] + ".jsonl"
+    if args.log:
+        gLogLevel = gLogLevels[args.loglevel]
+        OpenLog(args.logjson)
+    else:
         gLogFile = None
 
     # update search paths, removing any trailing path separators and adding default "." and "./templates"
@@ -732,12 +1959,27 @@ def main():
     # put in the work...
     if not args.edits:
         try:
-            csv = ReadCSV(args.definition)
-            if len(csv) == 0:
+            if os.path.splitext(args.definition)[1].lower() == ".xlsx":
+                # each worksheet provides its own set of groups
+                groups = [ ]
+                for _, rows in ReadXLSX(args.definition, args.sheet):
+                    groups.extend(CrackGroupsFromCSV(rows))
+            else:
+                if len(args.sheet) > 0:
+                    Log(f"Ignoring --sheet for non-XLSX definition {args.definition}", True, level="warn")
+                groups = CrackGroupsFromCSV(ReadCSV(args.definition))
+            if len(groups) == 0:
                 print(f"Definition file {args.definition} is empty, nothing to do")
             else:
-                for group in CrackGroupsFromCSV(csv):
-                    BuildGroup(args, group)
+                if not args.dry:
+                    gManifest = ReadManifest(args.output)
+                gRasterizer = NewRasterizer(args.renderer, args.jobs)
+                try:
+                    BuildGroups(args, groups)
+                finally:
+                    gRasterizer.Finish()
+                if gManifest is not None:
+                    WriteManifest(args.output, gManifest)
         except Exception as ex:
             print(ex)
             exit(-1)
@@ -0,0 +1,412 @@
+# *************************************************************************************************
+#
+# test_kbb.py: golden-file regression tests for kbb.py
+#
+# builds the example definitions in sdefs/ and the TW7 project definition in project/source/ with
+# --nopng and checks the .svg output is byte-identical to the golden files in golden/. the golden
+# files are gzip-compressed output of kbb.py and should only be updated when a change to kbb.py
+# intends to change its output.
+#
+# run with "python -m pytest tests" or "python -m unittest discover tests" from Kboard_Builder/.
+#
+# *************************************************************************************************
+
+import base64
+import collections
+import glob
+import gzip
+import importlib.util
+import io
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+import unittest.mock as mock
+import xml.etree.ElementTree as ET
+import zipfile
+
+gPathKBB = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+gPathGolden = os.path.join(os.path.dirname(os.path.abspath(__file__)), "golden")
+
+sys.path.insert(0, gPathKBB)
+import kbb
+
+# differences between the dark templates kbb.py derives and the _Dk templates shipped in templates/,
+# maps a _Dk template name to a map of ( tag, attribute ) onto the number of elements that differ
+# in that attribute ("text" is the element text). the shipped _Dk templates are used as is, these
+# differences are not color remaps: titles are named differently, the kola map border is red, and
+# the column headers in the dark grid are set in a larger font.
+#
+gDarkKnownDiffs = {
+    "Elems_Bases_Kola_Dk.svg" : { ( "title", "text" ) : 1, ( "g", "stroke" ) : 1 },
+    "Elems_Bases_Marianas_Dk.svg" : { ( "title", "text" ) : 1 },
+    "Elems_Bases_NTTR_Dk.svg" : { ( "title", "text" ) : 1 },
+    "Elems_Bases_Syria_Dk.svg" : { ( "title", "text" ) : 1 },
+    "Elems_Grid_Dk.svg" : { ( "title", "text" ) : 1, ( "text", "font-size" ) : 15, ( "tspan", "x" ) : 15,
+                            ( "tspan", "y" ) : 15 },
+    "KBT_Flight_Card_Dk.svg" : { },
+    "KBT_Grid_Card_Dk.svg" : { },
+}
+
+# ------------------------------------
+# build a definition with kbb.py into the output directory without .png files. extra holds
+# additional command line arguments. returns the completed process.
+#
+def RunKBB(definition, output, extra=[ ]):
+    args = [ sys.executable, "kbb.py", "--nopng", "--output", output, "--search", "project/source",
+             "--search", "docs/images" ] + extra + [ definition ]
+    return subprocess.run(args, cwd=gPathKBB, capture_output=True, text=True)
+
+# ------------------------------------
+# build a definition as RunKBB() does, but with worker processes started by the spawn start method
+# (the default on windows) so that workers only see the state kbb.py hands them explicitly.
+#
+def RunKBBSpawn(definition, output, extra=[ ]):
+    script = "import multiprocessing, sys, kbb; multiprocessing.set_start_method('spawn'); sys.argv.pop(0); kbb.main()"
+    args = [ sys.executable, "-c", script, "kbb.py", "--nopng", "--output", output, "--search", "project/source",
+             "--search", "docs/images" ] + extra + [ definition ]
+    return subprocess.run(args, cwd=gPathKBB, capture_output=True, text=True)
+
+# ------------------------------------
+# returns the contents of the file at the given path.
+#
+def ReadFile(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+# ------------------------------------
+# returns the contents of the golden file for the given .svg output file name.
+#
+def ReadGolden(name):
+    with gzip.open(os.path.join(gPathGolden, f"{name}.gz"), "rb") as f:
+        return f.read()
+
+class TestGoldenBuilds(unittest.TestCase):
+
+    # ------------------------------------
+    # build each definition into a fresh output directory and check every golden file named in
+    # names matches the .svg kbb.py produced.
+    #
+    def CheckBuild(self, definitions, names, extra=[ ]):
+        with tempfile.TemporaryDirectory() as output:
+            for definition in definitions:
+                result = RunKBB(definition, output, extra)
+                self.assertEqual(result.returncode, 0, f"{definition}: {result.stdout}{result.stderr}")
+            for name in names:
+                with self.subTest(name=name):
+                    with open(os.path.join(output, name), "rb") as f:
+                        self.assertTrue(f.read() == ReadGolden(name), f"{name} differs from golden file")
+
+    def test_sdefs(self):
+        self.CheckBuild(sorted(glob.glob("sdefs/*.csv", root_dir=gPathKBB)),
+                        [ "KBT_Flight_Card_Example.svg", "KBT_Grid_Card_Example.svg" ])
+
+    def test_project(self):
+        self.CheckBuild([ "project/source/TW7_Kneeboards.csv" ],
+                        [ "00_TW7_LO1_Flight_Card.svg", "00_TW7_PN7_Flight_Card.svg",
+                          "01_TW7_LO1_Details.svg", "01_TW7_PN7_Details.svg" ])
+
+    def test_project_jobs(self):
+        self.CheckBuild([ "project/source/TW7_Kneeboards.csv" ],
+                        [ "00_TW7_LO1_Flight_Card.svg", "00_TW7_PN7_Flight_Card.svg",
+                          "01_TW7_LO1_Details.svg", "01_TW7_PN7_Details.svg" ],
+                        extra=[ "--jobs", "3" ])
+
+    def test_sdefs_xlsx(self):
+        self.CheckBuild(sorted(glob.glob("sdefs/*.xlsx", root_dir=gPathKBB)),
+                        [ "KBT_Flight_Card_Example.svg", "KBT_Grid_Card_Example.svg" ])
+
+# ------------------------------------
+# returns a counter of the differences between two svg trees with the same structure, counting the
+# elements that differ in each ( tag, attribute ) as gDarkKnownDiffs does. returns None if the
+# trees do not have the same elements in the same order.
+#
+def DiffSVG(xmlRootA, xmlRootB):
+    elemsA = list(xmlRootA.iter())
+    elemsB = list(xmlRootB.iter())
+    if [ x.tag for x in elemsA ] != [ x.tag for x in elemsB ]:
+        return None
+    diffs = collections.Counter()
+    for elemA, elemB in zip(elemsA, elemsB):
+        tag = elemA.tag.rpartition("}")[2]
+        for attr in set(elemA.attrib) | set(elemB.attrib):
+            if elemA.get(attr) != elemB.get(attr):
+                diffs[( tag, attr.rpartition("}")[2] )] += 1
+        if (elemA.text or "").strip() != (elemB.text or "").strip():
+            diffs[( tag, "text" )] += 1
+    return diffs
+
+class TestDarkTemplates(unittest.TestCase):
+
+    # derive each shipped _Dk template from its light template (copied somewhere without the _Dk
+    # template) and check it only differs from the shipped template as gDarkKnownDiffs expects.
+    def test_derived_matches_shipped(self):
+        names = sorted([ x for x in os.listdir(os.path.join(gPathKBB, "templates")) if x.endswith("_Dk.svg") ])
+        self.assertEqual(names, sorted(gDarkKnownDiffs.keys()))
+        with tempfile.TemporaryDirectory() as tmpDir:
+            for name in names:
+                with self.subTest(name=name):
+                    shutil.copyfile(os.path.join(gPathKBB, "templates", name.replace("_Dk", "")),
+                                    os.path.join(tmpDir, name.replace("_Dk", "")))
+                    xmlTree = kbb.ReadSVGCached(os.path.join(tmpDir, name))[0]
+                    diffs = DiffSVG(xmlTree.getroot(), ET.parse(os.path.join(gPathKBB, "templates", name)).getroot())
+                    self.assertIsNotNone(diffs, f"{name} does not have the structure of its light template")
+                    self.assertEqual(dict(diffs), gDarkKnownDiffs[name])
+
+class TestParallelBuilds(unittest.TestCase):
+
+    def test_dark_jobs_spawn(self):
+        definition = "project/source/TW7_Kneeboards.csv"
+        with tempfile.TemporaryDirectory() as outSerial, tempfile.TemporaryDirectory() as outJobs:
+            result = RunKBB(definition, outSerial, [ "--dark" ])
+            self.assertEqual(result.returncode, 0, f"{result.stdout}{result.stderr}")
+            result = RunKBBSpawn(definition, outJobs, [ "--dark", "--jobs", "2" ])
+            self.assertEqual(result.returncode, 0, f"{result.stdout}{result.stderr}")
+            names = sorted([ x for x in os.listdir(outSerial) if x.endswith(".svg") ])
+            self.assertEqual(len(names), 4)
+            for name in names:
+                with self.subTest(name=name):
+                    self.assertTrue(ReadFile(os.path.join(outJobs, name)) == ReadFile(os.path.join(outSerial, name)),
+                                    f"{name} from --jobs differs from serial build")
+                    self.assertFalse(ReadFile(os.path.join(outSerial, name)) == ReadGolden(name),
+                                     f"{name} from --dark matches the day build")
+
+class TestIncrementalBuilds(unittest.TestCase):
+
+    # ------------------------------------
+    # build the project definition into output and return the names of the outputs kbb.py built
+    # and the names of the outputs it skipped as up to date.
+    #
+    def Build(self, output, extra=[ ]):
+        result = RunKBB("project/source/TW7_Kneeboards.csv", output, extra)
+        self.assertEqual(result.returncode, 0, f"{result.stdout}{result.stderr}")
+        built = re.findall(r'^Building .* output "(.*)"$', result.stdout, re.MULTILINE)
+        skipped = re.findall(r'^Skipping .* output "(.*)" is up to date$', result.stdout, re.MULTILINE)
+        return sorted([ os.path.basename(x) for x in built ]), sorted([ os.path.basename(x) for x in skipped ])
+
+    def test_skip_and_force(self):
+        names = [ "00_TW7_LO1_Flight_Card", "00_TW7_PN7_Flight_Card", "01_TW7_LO1_Details", "01_TW7_PN7_Details" ]
+        with tempfile.TemporaryDirectory() as output:
+            self.assertEqual(self.Build(output), ( names, [ ] ))
+            mtimes = [ os.stat(os.path.join(output, f"{x}.svg")).st_mtime_ns for x in names ]
+
+            self.assertEqual(self.Build(output), ( [ ], names ))
+            self.assertEqual([ os.stat(os.path.join(output, f"{x}.svg")).st_mtime_ns for x in names ], mtimes)
+
+            os.remove(os.path.join(output, f"{names[1]}.svg"))
+            self.assertEqual(self.Build(output), ( [ names[1] ], names[:1] + names[2:] ))
+
+            self.assertEqual(self.Build(output, [ "--force" ]), ( names, [ ] ))
+            for name in names:
+                with self.subTest(name=name):
+                    self.assertTrue(ReadFile(os.path.join(output, f"{name}.svg")) == ReadGolden(f"{name}.svg"),
+                                    f"{name}.svg differs from golden file")
+
+            # options that change the output are part of what makes a kneeboard up to date.
+            self.assertEqual(self.Build(output, [ "--night" ]), ( names, [ ] ))
+            self.assertEqual(self.Build(output, [ "--night" ]), ( [ ], names ))
+
+# an svg for MinifySVG() with editor data, whitespace between elements and in text, a def used
+# through url() that uses another def through an href, and a def nothing uses.
+#
+gMinifySVG = """<svg xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink"
+     xmlns:inkscape="http://www.inkscape.org/namespaces/inkscape"
+     xmlns:sodipodi="http://sodipodi.sourceforge.net/DTD/sodipodi-0.dtd" inkscape:version="1.2">
+  <metadata><title>Meta</title></metadata>
+  <sodipodi:namedview id="View" />
+  <defs>
+    <linearGradient id="Used"><stop offset="0" /></linearGradient>
+    <linearGradient id="UsedByUsed" xlink:href="#Used" />
+    <linearGradient id="Unused"><stop offset="1" /></linearGradient>
+  </defs>
+  <g id="Layer" inkscape:label="Layer" inkscape:groupmode="layer">
+    <rect id="Box" style="fill:url(#UsedByUsed)" sodipodi:nodetypes="cccc" />
+    <text id="Label"> A <tspan>B</tspan> C </text>
+  </g>
+</svg>
+"""
+
+class TestOutputOptions(unittest.TestCase):
+
+    def test_minify(self):
+        xmlRoot = ET.fromstring(gMinifySVG)
+        kbb.MinifySVG(xmlRoot)
+        self.assertEqual([ x.get("id") for x in xmlRoot.iter() if x.get("id") is not None ],
+                         [ "Used", "UsedByUsed", "Layer", "Box", "Label" ])
+        self.assertEqual([ x.tag for x in xmlRoot.iter() if not x.tag.startswith(kbb.gSVGNS) ], [ ])
+        self.assertEqual([ x.tag for x in xmlRoot.iter() if x.tag.endswith("metadata") ], [ ])
+        self.assertEqual([ ( x.tag, a ) for x in xmlRoot.iter() for a in x.attrib if a.startswith(kbb.gSVGEditorNS) ],
+                         [ ])
+        self.assertEqual([ x for x in xmlRoot.iter() if x.tag != f"{kbb.gSVGNS}tspan" and
+                           ((x.text or "").isspace() or (x.tail or "").isspace()) ], [ ])
+        self.assertEqual("".join(xmlRoot.find(f".//{kbb.gSVGNS}text").itertext()), " A B C ")
+
+    # ------------------------------------
+    # build the project with extra arguments and return a map of output file name onto its contents.
+    #
+    def Build(self, extra):
+        with tempfile.TemporaryDirectory() as output:
+            result = RunKBB("project/source/TW7_Kneeboards.csv", output, extra)
+            self.assertEqual(result.returncode, 0, f"{result.stdout}{result.stderr}")
+            return { x : ReadFile(os.path.join(output, x)) for x in os.listdir(output) if x.startswith("0") }
+
+    def test_svgz(self):
+        outputs = self.Build([ "--svgz" ])
+        self.assertEqual(sorted(outputs.keys()), [ "00_TW7_LO1_Flight_Card.svgz", "00_TW7_PN7_Flight_Card.svgz",
+                                                   "01_TW7_LO1_Details.svgz", "01_TW7_PN7_Details.svgz" ])
+        for name, data in outputs.items():
+            with self.subTest(name=name):
+                self.assertTrue(gzip.decompress(data) == ReadGolden(name.replace(".svgz", ".svg")),
+                                f"{name} does not gunzip to the golden file")
+
+    def test_minify_svgz(self):
+        outputs = self.Build([ "--minify", "--svgz" ])
+        self.assertEqual(len(outputs), 4)
+        for name, data in outputs.items():
+            with self.subTest(name=name):
+                xmlRoot = ET.fromstring(gzip.decompress(data))
+                xmlRootGolden = ET.fromstring(ReadGolden(name.replace(".svgz", ".svg")))
+                self.assertEqual(xmlRoot.tag, f"{kbb.gSVGNS}svg")
+                self.assertEqual(xmlRoot.attrib, xmlRootGolden.attrib)
+                self.assertEqual([ "".join(x.itertext()) for x in xmlRoot.iter(f"{kbb.gSVGNS}text") ],
+                                 [ "".join(x.itertext()) for x in xmlRootGolden.iter(f"{kbb.gSVGNS}text") ])
+                self.assertLess(len(gzip.decompress(data)), len(ReadGolden(name.replace(".svgz", ".svg"))))
+
+# ------------------------------------
+# returns the pillow image for the .png data embedded in the first <image> with id ".png" in svg.
+#
+def ReadEmbeddedPNG(svg):
+    from PIL import Image
+
+    xmlRoot = ET.fromstring(svg)
+    href = [ x for x in xmlRoot.iter(f"{kbb.gSVGNS}image") if x.get("id") == ".png" ][0].get("href")
+    return Image.open(io.BytesIO(base64.b64decode(href.partition(",")[2])))
+
+@unittest.skipIf(importlib.util.find_spec("PIL") is None, "--resample requires pillow")
+class TestResample(unittest.TestCase):
+
+    # ------------------------------------
+    # write a png of the given size with a pattern that does not compress away.
+    #
+    def WritePNG(self, path, size):
+        from PIL import Image
+
+        image = Image.new("RGB", size)
+        image.putdata([ ( x % 256, y % 256, (x * y) % 256 ) for y in range(size[1]) for x in range(size[0]) ])
+        image.save(path)
+
+    def test_resample_png(self):
+        from PIL import Image
+
+        with tempfile.TemporaryDirectory() as tmpDir:
+            path = os.path.join(tmpDir, "big.png")
+            self.WritePNG(path, ( 400, 200 ))
+            data = kbb.ResamplePNG(path, "100", "100")
+            self.assertLess(len(data), os.path.getsize(path))
+            with Image.open(io.BytesIO(data)) as image:
+                self.assertEqual(image.size, ( 100, 50 ))
+            self.assertTrue(kbb.ResamplePNG(path, "400", "200") == ReadFile(path))
+            self.assertTrue(kbb.ResamplePNG(path, "800", "800") == ReadFile(path))
+
+    def test_resample_build(self):
+        with tempfile.TemporaryDirectory() as output:
+            for definition in sorted(glob.glob("sdefs/*.csv", root_dir=gPathKBB)):
+                result = RunKBB(definition, output, [ "--resample" ])
+                self.assertEqual(result.returncode, 0, f"{definition}: {result.stdout}{result.stderr}")
+            svg = ReadFile(os.path.join(output, "KBT_Grid_Card_Example.svg"))
+            self.assertTrue(ReadFile(os.path.join(output, "KBT_Flight_Card_Example.svg")) ==
+                            ReadGolden("KBT_Flight_Card_Example.svg"), "images in templates are not resampled")
+        svgGolden = ReadGolden("KBT_Grid_Card_Example.svg")
+
+        # the 1440x1750 image in docs/images is downsampled to fit its 720x750 slot, nothing else changes.
+        with ReadEmbeddedPNG(svg) as image, ReadEmbeddedPNG(svgGolden) as imageGolden:
+            self.assertEqual(imageGolden.size, ( 1440, 1750 ))
+            self.assertEqual(image.size, ( 617, 750 ))
+        self.assertLess(len(svg), len(svgGolden))
+        regexPNG = re.compile(rb'href="data:image/png;base64,[^"]*"')
+        self.assertTrue(regexPNG.sub(b"", svg) == regexPNG.sub(b"", svgGolden))
+
+# an svg element library with elements indexed by byte offset (Shallow), elements too deep to be
+# indexed (Deep), and elements under an element that declares a namespace (Declared).
+#
+gLibrarySVG = """<svg xmlns="http://www.w3.org/2000/svg">
+  <g id="Shallow"><g id="Middle"><rect id="Deep" width="1" /></g></g>
+  <g id="Declaring" xmlns:xlink="http://www.w3.org/1999/xlink"><use id="Declared" xlink:href="#Deep" /></g>
+</svg>
+"""
+
+class TestElementLibrary(unittest.TestCase):
+
+    def test_read_element(self):
+        with tempfile.TemporaryDirectory() as tmpDir:
+            path = os.path.join(tmpDir, "Library.svg")
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(gLibrarySVG)
+            with mock.patch.object(kbb, "gTmpltCache", collections.OrderedDict()), \
+                 mock.patch.object(kbb, "gSVGOffsetCache", { }), \
+                 mock.patch.object(kbb, "IndexSVGOffsets", wraps=kbb.IndexSVGOffsets) as index, \
+                 mock.patch.object(kbb, "ExtractSVGElement", wraps=kbb.ExtractSVGElement) as extract:
+                for id, idsChild in [ ( "Shallow", [ "middle", "deep" ] ), ( "Deep", [ ] ), ( "Declared", [ ] ) ]:
+                    with self.subTest(id=id):
+                        xmlTree, elemIndex, _ = kbb.ReadSVGElementCached(path, kbb.SanitizeKey(id))
+                        self.assertEqual(xmlTree.getroot().get("id"), id)
+                        self.assertEqual(sorted(elemIndex.keys()), sorted([ kbb.SanitizeKey(id) ] + idsChild))
+                self.assertEqual(extract.call_count, 2)
+
+                # ids the library does not have are answered from its index, however often they are looked up.
+                for _ in range(3):
+                    self.assertIsNone(kbb.ReadSVGElementCached(path, "missing")[0])
+                self.assertEqual(index.call_count, 1)
+                self.assertEqual(extract.call_count, 2)
+
+# ------------------------------------
+# write an .xlsx workbook with one worksheet to the given path, where rows is an array of row
+# columns. every cell is a shared string.
+#
+def WriteXLSX(path, rows):
+    ns = 'xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"'
+    nsRel = 'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships"'
+    nsPkgRel = 'xmlns="http://schemas.openxmlformats.org/package/2006/relationships"'
+    typeRel = "http://schemas.openxmlformats.org/officeDocument/2006/relationships"
+    strings = [ x for row in rows for x in row ]
+    sheet = "".join([ f'<row r="{iRow + 1}">' +
+                      "".join([ f'<c r="{chr(ord("A") + iCol)}{iRow + 1}" t="s"><v>{strings.index(x)}</v></c>'
+                                for iCol, x in enumerate(row) ]) + "</row>" for iRow, row in enumerate(rows) ])
+    with zipfile.ZipFile(path, "w") as zf:
+        zf.writestr("xl/_rels/workbook.xml.rels",
+                    f'<Relationships {nsPkgRel}>'
+                    f'<Relationship Id="rId1" Type="{typeRel}/worksheet" Target="worksheets/sheet1.xml"/>'
+                    f'<Relationship Id="rId2" Type="{typeRel}/sharedStrings" Target="sharedStrings.xml"/>'
+                    f'</Relationships>')
+        zf.writestr("xl/workbook.xml",
+                    f'<workbook {ns} {nsRel}><sheets><sheet name="Sheet" r:id="rId1"/></sheets></workbook>')
+        zf.writestr("xl/sharedStrings.xml",
+                    f'<sst {ns}>' + "".join([ f"<si><t>{x}</t></si>" for x in strings ]) + "</sst>")
+        zf.writestr("xl/worksheets/sheet1.xml", f'<worksheet {ns}><sheetData>{sheet}</sheetData></worksheet>')
+
+class TestXLSX(unittest.TestCase):
+
+    def test_read_xlsx(self):
+        rows = [ [ f"R{iRow}C{iCol}" for iCol in range(3) ] for iRow in range(50) ]
+        parses = [ ]
+        def IterParse(*args, **kwargs):
+            parses.append(iterparse(*args, **kwargs))
+            return parses[-1]
+
+        iterparse = ET.iterparse
+        with tempfile.TemporaryDirectory() as tmpDir, mock.patch.object(kbb.ET, "iterparse", IterParse):
+            path = os.path.join(tmpDir, "Rows.xlsx")
+            WriteXLSX(path, rows)
+            sheets = [ ( name, list(rowsRead) ) for name, rowsRead in kbb.ReadXLSX(path) ]
+        self.assertEqual(sheets, [ ( "Sheet", [ ( iRow + 1, row ) for iRow, row in enumerate(rows) ] ) ])
+
+        # the shared strings and rows are dropped from the partial trees as they are read.
+        self.assertEqual(len(parses), 2)
+        self.assertEqual(len(parses[0].root), 0)
+        self.assertEqual(len(parses[1].root.find(f"{kbb.gXLSXNS}sheetData")), 0)
+
+if __name__ == "__main__":
+    unittest.main()
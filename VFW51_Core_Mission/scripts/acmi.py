@@ -0,0 +1,248 @@
+# *********************************************************************************************************************
+#
+# acmi.py -- incremental tokenizer for tacview .acmi 2.x text files
+#
+# see https://www.tacview.net/documentation/acmi/en/ for more details on the .acmi file format.
+#
+# Copyright (C) 2023 ilominar
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# *********************************************************************************************************************
+
+import io
+import re
+
+# ---- records --------------------------------------------------------------------------------------------------------
+
+# the tokenizer yields ( kind, key, raw ) tuples for each logical line in the file. raw is the text of the line
+# exactly as it appears in the file (including its line ending and any continuation lines) so writing raw back out
+# reproduces the input. key depends on kind,
+#
+#     ACMI_FRAME    "#<time>" frame line, key is the time (float, None if it does not parse)
+#     ACMI_OBJECT   "<id>,<props>" object update, key is the object id
+#     ACMI_REMOVE   "-<id>" object removal, key is the object id
+#     ACMI_GLOBAL   "0,<props>" global properties and events, key is "0"
+#     ACMI_OTHER    blank lines, "//" comments, and anything else, key is None
+#
+# properties are not cracked by the tokenizer, use acmi_props() on raw to get them. this keeps the cost of lines that
+# do not need their properties (most of them) down to a couple of string searches.
+
+ACMI_FRAME = 0
+ACMI_OBJECT = 1
+ACMI_REMOVE = 2
+ACMI_GLOBAL = 3
+ACMI_OTHER = 4
+
+acmi_bom = "\ufeff"
+
+# properties are separated by commas that are not escaped with a "\".
+#
+acmi_prop_split_regex = re.compile(r"(?<!\\),")
+
+# ---- tokenizer ------------------------------------------------------------------------------------------------------
+
+# wrap a binary stream for the tokenizer. lines only end at "\n" and undecodable bytes are carried through as
+# surrogates so raw text written to a stream from acmi_open_text_write() matches the input byte-for-byte.
+#
+def acmi_open_text(fh_bin):
+    return io.TextIOWrapper(fh_bin, encoding='utf-8', errors='surrogateescape', newline="\n")
+
+def acmi_open_text_write(fh_bin):
+    return io.TextIOWrapper(fh_bin, encoding='utf-8', errors='surrogateescape', newline="")
+
+# read the two header lines from a text stream from acmi_open_text() and verify the type and version. returns
+# ( file_type, file_version, raw ) where file_type and file_version are stripped of the BOM and whitespace and raw is
+# the text of both lines as they appear in the file. throws an exception if the header is not acmi 2.x.
+#
+def acmi_read_header(fh_text, path):
+    ln_ft = fh_text.readline()
+    ln_fv = fh_text.readline()
+    file_type = ln_ft.removeprefix(acmi_bom).strip()
+    file_version = ln_fv.strip()
+    if not file_type.casefold().endswith("filetype=text/acmi/tacview") or \
+        not file_version.casefold().startswith("fileversion=2."):
+        raise Exception(f"Unsupported file format for {path}")
+    return file_type, file_version, ln_ft + ln_fv
+
+# skip the two header lines in a binary stream, see acmi_read_chunks(). returns the size of the header in bytes.
+#
+def acmi_skip_header(fh_bin):
+    return len(fh_bin.readline()) + len(fh_bin.readline())
+
+# read the body of an acmi file from a binary stream (positioned past the header) in frame-aligned chunks of roughly
+# chunk_size bytes. every chunk after the first starts with a "#<time>" frame line and no chunk splits a line or a
+# continuation.
+#
+def acmi_read_chunks(fh_bin, chunk_size):
+    pending = b""
+    while True:
+        data = fh_bin.read(chunk_size)
+        if not data:
+            break
+        buf = pending + data
+        split = buf.rfind(b"\n#")
+        while split > 0:
+            # a frame line that follows a continuation is part of the continued line, keep looking.
+            i = split
+            while i > 0 and buf[i-1:i] in (b" ", b"\t", b"\r"):
+                i -= 1
+            if buf[i-1:i] != b"\\":
+                break
+            split = buf.rfind(b"\n#", 0, split)
+        if split > 0:
+            yield buf[:split+1]
+            pending = buf[split+1:]
+        else:
+            pending = buf
+    if len(pending) > 0:
+        yield pending
+
+# returns True if a line continues on the next line (its text ends with a "\").
+#
+def acmi_is_continued(line):
+    return "\\" in line and line.rstrip().endswith("\\")
+
+# returns the ( kind, key, raw ) record for a logical line, see above.
+#
+def acmi_classify(raw):
+    lead = raw[:1]
+    if lead == "#":
+        try:
+            time = float(raw[1:])
+        except ValueError:
+            time = None
+        return ACMI_FRAME, time, raw
+    elif lead == "-":
+        return ACMI_REMOVE, raw[1:].strip(), raw
+    gid = acmi_line_gid(raw)
+    if gid == "" or gid.startswith("//") or "=" in gid:
+        return ACMI_OTHER, None, raw
+    elif gid.lstrip("0") == "":
+        return ACMI_GLOBAL, gid, raw
+    return ACMI_OBJECT, gid, raw
+
+# yield ( kind, key, raw ) records for the logical lines in a text stream from acmi_open_text(), see above. the
+# stream should be positioned past the header.
+#
+def acmi_records(fh_text):
+    for raw in fh_text:
+        if acmi_is_continued(raw):
+            parts = [ raw ]
+            while acmi_is_continued(parts[-1]):
+                line = fh_text.readline()
+                if not line:
+                    break
+                parts.append(line)
+            raw = "".join(parts)
+        yield acmi_classify(raw)
+
+# yield ( kind, key, raw, offset, size ) records for the logical lines in a binary stream positioned offset bytes
+# into the file (past the header), where offset and size locate the raw text in the file. this is slower than
+# acmi_records() and is meant for building indexes of the file.
+#
+def acmi_records_at(fh_bin, offset):
+    for line in fh_bin:
+        size = len(line)
+        if b"\\" in line and line.rstrip().endswith(b"\\"):
+            parts = [ line ]
+            while parts[-1].rstrip().endswith(b"\\"):
+                line = fh_bin.readline()
+                if not line:
+                    break
+                parts.append(line)
+                size += len(line)
+            line = b"".join(parts)
+        kind, key, raw = acmi_classify(line.decode('utf-8', errors='surrogateescape'))
+        yield kind, key, raw, offset, size
+        offset += size
+
+# ---- lines ----------------------------------------------------------------------------------------------------------
+
+# returns the object id from an object or global line without cracking its properties.
+#
+def acmi_line_gid(raw):
+    comma = raw.find(",")
+    if comma > 0 and not raw[0].isspace():
+        return raw[:comma]
+    return raw.strip().partition(",")[0]
+
+# returns the value of the transform ("T") property from an object line without cracking its properties, None if
+# the line has no transform.
+#
+def acmi_line_transform(raw):
+    start = raw.find(",T=")
+    if start < 0:
+        start = raw.find(",t=")
+        if start < 0:
+            return None
+    start += 3
+    end = raw.find(",", start)
+    return raw[start:end].strip() if end >= 0 else raw[start:].strip()
+
+# returns a copy of an object line with the value of its transform ("T") property replaced by value, the line is
+# returned as is if it has no transform.
+#
+def acmi_replace_transform(raw, value):
+    start = raw.find(",T=")
+    if start < 0:
+        start = raw.find(",t=")
+        if start < 0:
+            return raw
+    start += 3
+    end = raw.find(",", start)
+    if end < 0:
+        end = len(raw.rstrip("\r\n"))
+    return raw[:start] + value + raw[end:]
+
+# merge a transform ("T") value into the current transform for an object. acmi transforms are delta updates where
+# empty components keep their previous value. cur is a list of the text of each component ("" if unknown) or None if
+# there is no current transform. returns the merged transform, "|".join() of which gives the full transform value.
+#
+def acmi_merge_transform(cur, value):
+    parts = value.split("|")
+    if cur == None:
+        return parts
+    elif len(cur) < len(parts):
+        cur = cur + [ "" ] * (len(parts) - len(cur))
+    for i, part in enumerate(parts):
+        if part != "":
+            cur[i] = part
+    return cur
+
+# returns the value of a property with escapes ("\," and "\" line continuations) removed.
+#
+def acmi_unescape(value):
+    if "\\" not in value:
+        return value
+    return value.replace("\\\r\n", "\n").replace("\\\n", "\n").replace("\\,", ",")
+
+# returns a list of ( key, value ) for the properties of an object or global line as they appear in the line (keys
+# keep their case and values keep their escapes).
+#
+def acmi_raw_props(raw):
+    fields = acmi_prop_split_regex.split(raw.rstrip("\r\n"))
+    return [ tuple(field.partition("=")[0::2]) for field in fields[1:] ]
+
+# returns a map of properties:values (keys are always lowercase, values are unescaped) for an object or global line
+# along with the object id under the "gid" key. if a property repeats, the last value wins. properties without a
+# value map to "".
+#
+def acmi_props(raw):
+    fields = acmi_prop_split_regex.split(raw.rstrip("\r\n"))
+    props = { "gid" : fields[0].strip() }
+    for field in fields[1:]:
+        key, _, value = field.partition("=")
+        props[key.strip().casefold()] = acmi_unescape(value)
+    return props
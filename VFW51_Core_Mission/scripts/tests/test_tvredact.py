@@ -0,0 +1,428 @@
+# *********************************************************************************************************************
+#
+# test_tvredact.py -- regression tests for tvredact.py
+#
+# the golden tests redact data/sample.txt.acmi with data/sample_rules.txt through each of the redaction paths (serial,
+# parallel with and without a catalog, compressed input and output) and dump its objects, checking the output is
+# byte-identical to the golden files in data/. the golden files should only be updated when a change to tvredact.py or
+# acmi.py intends to change its output. the other tests check the parts of tvredact.py against small inputs with known
+# results.
+#
+# run with "python -m pytest tests" or "python -m unittest discover tests" from VFW51_Core_Mission/scripts.
+#
+# *********************************************************************************************************************
+
+import contextlib
+import importlib
+import io
+import itertools
+import os
+import re
+import shutil
+import sys
+import tempfile
+import unittest
+import zipfile
+
+path_tests = os.path.dirname(os.path.abspath(__file__))
+path_data = os.path.join(path_tests, "data")
+
+sys.path.insert(0, os.path.dirname(path_tests))
+import tvredact
+
+# ---- utility functions ----------------------------------------------------------------------------------------------
+
+def read_bytes(path):
+    with open(path, "rb") as fh:
+        return fh.read()
+
+def read_zip_member(path):
+    with zipfile.ZipFile(path) as zf:
+        return zf.read(zf.namelist()[0])
+
+# returns true if the first member of a .zip archive was written with zip64 extensions.
+#
+def is_zip64_member(path):
+    with zipfile.ZipFile(path) as zf:
+        return zf.infolist()[0].extract_version >= zipfile.ZIP64_VERSION
+
+# run the tvredact command line with args in the directory cwd (where tvredact puts its output). the module is reloaded
+# to reset the state main() keeps in globals, and the parallel pipeline uses small chunks so the sample is split across
+# many chunks and workers. returns the exit code.
+#
+def run_tvredact(args, cwd):
+    importlib.reload(tvredact)
+    tvredact.acmi_chunk_size = 2048
+    argv = sys.argv
+    cwd_prev = os.getcwd()
+    sys.argv = [ "tvredact.py" ] + args
+    os.chdir(cwd)
+    try:
+        tvredact.main()
+    except SystemExit as ex:
+        return ex.code
+    finally:
+        sys.argv = argv
+        os.chdir(cwd_prev)
+    return 0
+
+# ---- golden tests ---------------------------------------------------------------------------------------------------
+
+class TestGoldenRedact(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.rules = os.path.join(path_data, "sample_rules.txt")
+        self.golden = read_bytes(os.path.join(path_data, "sample-REDACTED.txt.acmi"))
+        shutil.copyfile(os.path.join(path_data, "sample.txt.acmi"), self.tmp_path("sample.txt.acmi"))
+        with zipfile.ZipFile(self.tmp_path("sample.zip.acmi"), "w", compression=zipfile.ZIP_DEFLATED) as zf:
+            zf.write(self.tmp_path("sample.txt.acmi"), "sample.txt.acmi")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def tmp_path(self, name):
+        return os.path.join(self.tmp.name, name)
+
+    def check_redact(self, name, args=[ ]):
+        self.assertEqual(run_tvredact(args + [ "-r", self.rules, self.tmp_path(name) ], self.tmp.name), 0)
+        if name.endswith(".zip.acmi"):
+            self.assertTrue(read_zip_member(self.tmp_path("sample-REDACTED.zip.acmi")) == self.golden)
+            self.assertFalse(is_zip64_member(self.tmp_path("sample-REDACTED.zip.acmi")))
+        else:
+            self.assertTrue(read_bytes(self.tmp_path("sample-REDACTED.txt.acmi")) == self.golden)
+
+    def test_serial(self):
+        self.check_redact("sample.txt.acmi")
+
+    def test_parallel(self):
+        self.check_redact("sample.txt.acmi", [ "-j", "3" ])
+
+    def test_parallel_catalog(self):
+        self.assertEqual(run_tvredact([ "-d", self.tmp_path("sample.txt.acmi") ], self.tmp.name), 0)
+        self.assertTrue(os.path.exists(self.tmp_path("sample-CATALOG.json")))
+        self.check_redact("sample.txt.acmi", [ "-j", "3" ])
+
+    def test_zip(self):
+        self.check_redact("sample.zip.acmi")
+
+    def test_zip_parallel(self):
+        self.check_redact("sample.zip.acmi", [ "-j", "3" ])
+
+    def test_zip64(self):
+        size = os.path.getsize(self.tmp_path("sample.txt.acmi"))
+        self.assertEqual(tvredact.acmi_data_size(self.tmp_path("sample.zip.acmi"), ".zip"), size)
+        self.assertEqual(tvredact.acmi_data_size(self.tmp_path("sample.txt.acmi"), ".txt"), size)
+        for size_hint, is_zip64 in [ ( 0, False ), ( tvredact.acmi_zip64_size - 1, False ),
+                                     ( tvredact.acmi_zip64_size, True ), ( None, True ) ]:
+            with self.subTest(size_hint=size_hint):
+                with contextlib.ExitStack() as stack:
+                    fh_out = tvredact.open_acmi_write(stack, self.tmp_path("out.zip.acmi"), ".zip", size_hint)
+                    fh_out.write(self.golden.decode())
+                self.assertEqual(is_zip64_member(self.tmp_path("out.zip.acmi")), is_zip64)
+                self.assertTrue(read_zip_member(self.tmp_path("out.zip.acmi")) == self.golden)
+
+    def test_dump(self):
+        self.assertEqual(run_tvredact([ "-d", self.tmp_path("sample.txt.acmi") ], self.tmp.name), 0)
+        self.assertTrue(read_bytes(self.tmp_path("sample-OBJECTS.txt")) ==
+                        read_bytes(os.path.join(path_data, "sample-OBJECTS.txt")))
+
+# ---- redact rules ---------------------------------------------------------------------------------------------------
+
+# returns ( is_redacted, pattern ) for a handle by trying each pattern in order, as the redact loop did before the rules
+# were compiled into a RedactMatcher (with the "+" and "-" prefixes stripped from the patterns, as it intended).
+#
+def match_per_rule(patterns, handle):
+    for pattern in patterns:
+        is_whitelist = pattern.startswith("+")
+        regex = pattern.removeprefix("+").removeprefix("-")
+        if re.search(regex, handle, re.IGNORECASE):
+            return (not is_whitelist, regex)
+    return (False, None)
+
+# handles built from a mix of the properties in the sample, along with a few odd ones.
+#
+handles = [ ";".join(props) for props in itertools.product(
+    [ "Enemies", "Allies", "" ],
+    [ "Ground+AntiAircraft", "Weapon+Missile", "Air+FixedWing" ],
+    [ "RED EAST SA-15", "RED SA-10-1", "BLUE CAP", "RED CAP 1", "" ],
+    [ "Unit 1a", "SA-10 missile", "" ],
+    [ "RED EAST SA-15 1a", "Enfield 1-1", "" ]) ] + \
+    [ "Enemies;Ground;RED\nEAST SA-15;Unit 2;", "Enemies;;;;", ";;;;Unit 1a" ]
+
+class TestRedactMatcher(unittest.TestCase):
+
+    def check_rules(self, patterns, is_combined):
+        matcher = tvredact.RedactMatcher(patterns)
+        self.assertEqual(matcher.combined != None, is_combined)
+        for handle in handles:
+            with self.subTest(handle=handle):
+                self.assertEqual(matcher.match(handle), match_per_rule(patterns, handle))
+                self.assertEqual(matcher.match(handle), match_per_rule(patterns, handle))
+
+    def test_first_match_wins(self):
+        self.check_rules([ "+[^;]+;[^;]+;RED EAST SA-15;[^;]+;[^;]+", "[^;]+;[^;]+;RED EAST SA-[^;]+;[^;]+;[^;]+",
+                           "[^;]+;[^;]+;RED SA-10-1;[^;]+;[^;]+" ], True)
+        self.check_rules([ "RED EAST", "+SA-15", "-Enfield", "+Enemies" ], True)
+        self.check_rules([ "+SA-15", "RED EAST", "+Enemies", "-Enfield" ], True)
+
+    def test_anchors(self):
+        self.check_rules([ "^Enemies;Weapon", "+^Allies", "1a$", ";;;;" ], True)
+
+    def test_no_rules(self):
+        self.check_rules([ ], False)
+
+    def test_groups(self):
+        self.check_rules([ "+(RED|BLUE) CAP", "Enemies;(?:Ground|Air)" ], False)
+        self.check_rules([ "(?P<g>RED EAST SA-15);Unit 1a;(?P=g)", "Unit (\\w+);.*\\1$", "+RED", "Missile" ], False)
+
+    def test_inline_flags(self):
+        self.check_rules([ "+BLUE", "(?s)RED.EAST", "(?-i:enemies)" ], False)
+        self.check_rules([ "+BLUE", "(?-i:ENEMIES);(?i:weapon)", "CAP" ], True)
+
+# ---- spatial redaction ----------------------------------------------------------------------------------------------
+
+# data/radius.txt.acmi has a sam site (1) redacted by rule and a friendly one (2) 11 km north. at 10s, a weapon (a), a
+# handleless object (d), and a weapon east of the site (e) appear about 100 m from it, a weapon (b) appears 300 m north
+# (200 m from a), and a truck (c) and a whitelisted weapon (p) appear 100 m away. at 20s the site moves 2 km north, a
+# weapon (f) appears where it was and another (g) 55 m from where it is. the site is removed at 30s, a weapon (h)
+# appears where it was at 60s and another (i) at 60.5s.
+#
+radius_rules = [ "RED SAM", "+Patriot" ]
+
+# returns the ids of the objects redacted from data/radius.txt.acmi with a radius and window.
+#
+def radius_redacted(radius, window):
+    redactor = tvredact.Redactor(tvredact.RedactMatcher(radius_rules), radius, window)
+    with contextlib.ExitStack() as stack:
+        path = os.path.join(path_data, "radius.txt.acmi")
+        fh_in = tvredact.open_acmi_read(stack, path, ".txt")
+        tvredact.acmi_read_header(fh_in, path)
+        decisions = tvredact.build_redact_output(tvredact.acmi_records(fh_in), io.StringIO(), redactor)
+    return set([ gid for gid, value in decisions.items() if value == "REDACT" ])
+
+class TestRadiusRedact(unittest.TestCase):
+
+    def test_no_radius(self):
+        self.assertEqual(radius_redacted(0.0, 60.0), { "1" })
+
+    def test_radius(self):
+        # b is only near a, which was redacted for where it appeared and so does not redact what appears near it.
+        self.assertEqual(radius_redacted(200.0, 30.0), { "1", "a", "d", "e", "g", "h" })
+
+    def test_radius_edge(self):
+        self.assertEqual(radius_redacted(99.0, 30.0), { "1", "g", "h" })
+        self.assertEqual(radius_redacted(100.1, 30.0), { "1", "a", "d", "g", "h" })
+
+    def test_window_edge(self):
+        # h appears 30s after the site is removed, i 30.5s after.
+        self.assertEqual(radius_redacted(200.0, 60.0), { "1", "a", "d", "e", "g", "h", "i" })
+        self.assertEqual(radius_redacted(200.0, 30.0), { "1", "a", "d", "e", "g", "h" })
+        self.assertEqual(radius_redacted(200.0, 29.5), { "1", "a", "d", "e", "g" })
+
+    def test_parallel(self):
+        chunk_size = tvredact.acmi_chunk_size
+        tvredact.acmi_chunk_size = 64
+        try:
+            with tempfile.TemporaryDirectory() as tmp:
+                outputs = [ ]
+                for jobs in [ 1, 2 ]:
+                    output_path = os.path.join(tmp, f"out{jobs}.txt.acmi")
+                    tvredact.redact(os.path.join(path_data, "radius.txt.acmi"), output_path, radius_rules, jobs=jobs,
+                                    radius=200.0, window=30.0)
+                    outputs.append(read_bytes(output_path))
+        finally:
+            tvredact.acmi_chunk_size = chunk_size
+        self.assertTrue(outputs[0] == outputs[1])
+        self.assertNotIn(b"\nh,", outputs[0])
+        self.assertIn(b"\ni,", outputs[0])
+
+# ---- preview --------------------------------------------------------------------------------------------------------
+
+# data/preview.txt.acmi has objects that --redact decides on different lines: 1 is redacted on its first line, 2 is
+# kept on its first line (a transform with no handle) before a redacted handle shows up, 3 has a handle no rule
+# matches and 4 a whitelisted one before a line with a redacted handle, and 5 is kept.
+#
+preview_rules = [ "+Patriot", "RED SAM" ]
+
+class TestPreview(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def preview(self, path, rules):
+        fh_out = io.StringIO()
+        cat_path = os.path.join(self.tmp.name, tvredact.acmi_output_path(path, "CATALOG"))
+        tvredact.preview(path, rules, fh_out, cat_path)
+        return fh_out.getvalue()
+
+    def test_preview(self):
+        path = os.path.join(path_data, "preview.txt.acmi")
+        self.assertEqual(self.preview(path, preview_rules),
+                         "# <action> <coalition>;<type>;<group>;<name>;<pilot> <rule>\n"
+                         "redact ;;RED SAM;; RED SAM\n"
+                         "keep   Allies;Ground+AntiAircraft;RED SAM;Patriot; +Patriot\n"
+                         "redact Enemies;Ground+AntiAircraft;RED SAM;Late; RED SAM\n"
+                         "redact Enemies;Ground+AntiAircraft;RED SAM;SA-10; RED SAM\n"
+                         "\nWould redact 3 of 5 objects, 10 lines, 296 bytes (53.3% of the file)\n")
+
+    def test_preview_matches_redact(self):
+        cases = [ ( os.path.join(path_data, "preview.txt.acmi"), preview_rules ),
+                  ( os.path.join(path_data, "sample.txt.acmi"), os.path.join(path_data, "sample_rules.txt") ) ]
+        for path, rules in cases:
+            with self.subTest(path=path):
+                summary = tvredact.redact(path, os.path.join(self.tmp.name, "out.txt.acmi"), rules)
+                self.assertIn(f"Would redact {summary['redacted']} of ", self.preview(path, rules))
+
+# ---- batches --------------------------------------------------------------------------------------------------------
+
+class TestBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.rules = os.path.join(path_data, "sample_rules.txt")
+        for name in [ "a", "b", "out" ]:
+            os.mkdir(self.tmp_path(name))
+        shutil.copyfile(os.path.join(path_data, "sample.txt.acmi"), self.tmp_path("a/sample.txt.acmi"))
+        shutil.copyfile(os.path.join(path_data, "sample.txt.acmi"), self.tmp_path("b/sample.txt.acmi"))
+        shutil.copyfile(os.path.join(path_data, "preview.txt.acmi"), self.tmp_path("b/preview.txt.acmi"))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def tmp_path(self, name):
+        return os.path.join(self.tmp.name, name)
+
+    def test_find_output_collisions(self):
+        self.assertEqual(tvredact.find_output_collisions([ "a.txt.acmi", "b.txt.acmi" ]), [ ])
+        self.assertEqual(tvredact.find_output_collisions([ self.tmp_path("out/a.txt.acmi"), "b.txt.acmi",
+                                                           self.tmp_path("a/../out/a.txt.acmi") ]),
+                         [ self.tmp_path("out/a.txt.acmi"), self.tmp_path("a/../out/a.txt.acmi") ])
+
+    def test_batch(self):
+        paths = [ ( self.tmp_path("a/sample.txt.acmi"), self.tmp_path("out/sample-REDACTED.txt.acmi") ),
+                  ( self.tmp_path("b/missing.txt.acmi"), self.tmp_path("out/missing-REDACTED.txt.acmi") ),
+                  ( self.tmp_path("b/preview.txt.acmi"), self.tmp_path("out/preview-REDACTED.txt.acmi") ) ]
+        results = list(tvredact.redact_batch(paths, self.rules, jobs=2))
+        self.assertEqual([ input_path for input_path, _, _ in results ], [ input_path for input_path, _ in paths ])
+        self.assertEqual([ summary == None for _, summary, _ in results ], [ False, True, False ])
+        self.assertEqual([ error == None for _, _, error in results ], [ True, False, True ])
+        self.assertTrue(read_bytes(self.tmp_path("out/sample-REDACTED.txt.acmi")) ==
+                        read_bytes(os.path.join(path_data, "sample-REDACTED.txt.acmi")))
+        self.assertEqual(results[2][1]["output"], self.tmp_path("out/preview-REDACTED.txt.acmi"))
+
+    def test_batch_collision(self):
+        paths = [ ( self.tmp_path("a/sample.txt.acmi"), self.tmp_path("out/sample-REDACTED.txt.acmi") ),
+                  ( self.tmp_path("b/preview.txt.acmi"), self.tmp_path("out/preview-REDACTED.txt.acmi") ),
+                  ( self.tmp_path("b/sample.txt.acmi"), self.tmp_path("out/../out/sample-REDACTED.txt.acmi") ) ]
+        with self.assertRaises(Exception):
+            list(tvredact.redact_batch(paths, self.rules))
+        self.assertEqual(os.listdir(self.tmp_path("out")), [ ])
+
+    def test_cli_collision(self):
+        run_tvredact([ "-r", self.rules, self.tmp_path("a"), self.tmp_path("b") ], self.tmp_path("out"))
+        self.assertEqual(os.listdir(self.tmp_path("out")), [ ])
+
+    def test_expand_acmi_path(self):
+        for name in [ "sample-REDACTED.txt.acmi", "sample-REDACTED.zip.acmi", "sample-TRIMMED.txt.acmi",
+                      "sample-TRIMMED.zip.acmi", "sample-OBJECTS.txt", "sample-CATALOG.json" ]:
+            shutil.copyfile(self.tmp_path("a/sample.txt.acmi"), self.tmp_path(f"a/{name}"))
+        self.assertEqual(tvredact.expand_acmi_path(self.tmp_path("a")), [ self.tmp_path("a/sample.txt.acmi") ])
+        self.assertEqual(tvredact.expand_acmi_path(self.tmp_path("a/sample-REDACTED.txt.acmi")),
+                         [ self.tmp_path("a/sample-REDACTED.txt.acmi") ])
+
+# ---- trimming and decimation ----------------------------------------------------------------------------------------
+
+# data/trim.txt.acmi has a frame every second from 0s through 6s. an aircraft (1) updates its transform every frame
+# (leaving out its y at 2s), a sam site (2) is removed at 3s, a weapon (3) appears at 2s and moves once at 3s, an
+# event is sent at 2s, and the aircraft is removed at 6s.
+#
+trim_frames = [ "#0\n", "0,Title=Trim\n", "1,T=1|2|100,Type=Air+FixedWing,Name=F-16C_50\n",
+                "2,T=5|5|0,Type=Ground+AntiAircraft,Name=SA-10\n",
+                "#1\n", "1,T=1.1|2|110\n",
+                "#2\n", "1,T=1.2||120\n", "0,Event=Message|1|Fox 3\n", "3,T=9|9|9,Type=Weapon+Missile,Name=AIM-120C\n",
+                "#3\n", "1,T=1.3|2|130\n", "3,T=9.1|9|9\n", "-2\n",
+                "#4\n", "1,T=1.4|2|140\n",
+                "#5\n", "1,T=1.5|2|150\n",
+                "#6\n", "-1\n" ]
+
+# returns the lines trim_records() yields for the body of data/trim.txt.acmi.
+#
+def trim_lines(time_from=None, time_to=None, rate=0.0):
+    with contextlib.ExitStack() as stack:
+        path = os.path.join(path_data, "trim.txt.acmi")
+        fh_in = tvredact.open_acmi_read(stack, path, ".txt")
+        tvredact.acmi_read_header(fh_in, path)
+        return [ raw for _, _, raw in tvredact.trim_records(tvredact.acmi_records(fh_in), time_from, time_to, rate) ]
+
+class TestTrim(unittest.TestCase):
+
+    def test_no_trim(self):
+        self.assertEqual(trim_lines(), [ "0,ReferenceTime=2023-01-01T00:00:00Z\n" ] + trim_frames)
+
+    def test_from(self):
+        # everything before 2.5s is carried in as one line per object right after the first frame in the window.
+        self.assertEqual(trim_lines(time_from=2.5),
+                         [ "#3\n", "0,ReferenceTime=2023-01-01T00:00:00Z,Title=Trim\n",
+                           "1,T=1.2|2|120,Type=Air+FixedWing,Name=F-16C_50\n",
+                           "2,T=5|5|0,Type=Ground+AntiAircraft,Name=SA-10\n",
+                           "3,T=9|9|9,Type=Weapon+Missile,Name=AIM-120C\n" ] + trim_frames[11:])
+
+    def test_from_frame(self):
+        # a frame at time_from is in the window, the event from before the window is dropped and the one at
+        # time_from is kept.
+        self.assertEqual(trim_lines(time_from=2.0),
+                         [ "#2\n", "0,ReferenceTime=2023-01-01T00:00:00Z,Title=Trim\n",
+                           "1,T=1.1|2|110,Type=Air+FixedWing,Name=F-16C_50\n",
+                           "2,T=5|5|0,Type=Ground+AntiAircraft,Name=SA-10\n" ] + trim_frames[7:])
+
+    def test_from_removed(self):
+        # the sam site was removed before the window and is not carried in.
+        self.assertEqual(trim_lines(time_from=4.0),
+                         [ "#4\n", "0,ReferenceTime=2023-01-01T00:00:00Z,Title=Trim\n",
+                           "1,T=1.3|2|130,Type=Air+FixedWing,Name=F-16C_50\n",
+                           "3,T=9.1|9|9,Type=Weapon+Missile,Name=AIM-120C\n" ] + trim_frames[15:])
+
+    def test_to(self):
+        lines = [ "0,ReferenceTime=2023-01-01T00:00:00Z\n" ]
+        self.assertEqual(trim_lines(time_to=3.0), lines + trim_frames[:14])
+        self.assertEqual(trim_lines(time_to=2.5), lines + trim_frames[:10])
+
+    def test_from_to(self):
+        self.assertEqual(trim_lines(time_from=2.5, time_to=4.0), trim_lines(time_from=2.5)[:-4])
+
+    def test_rate(self):
+        # at 0.5hz the aircraft updates at 0s, 2s (with the transform merged from 1s), and 4s, its update at 5s is
+        # carried by a line right before it is removed. the weapon's update at 3s is carried by a line at the end.
+        # frames at 1s and 5s end up empty and are dropped.
+        self.assertEqual(trim_lines(rate=0.5),
+                         [ "0,ReferenceTime=2023-01-01T00:00:00Z\n" ] + trim_frames[:4] +
+                         [ "#2\n", "1,T=1.2|2|120\n" ] + trim_frames[8:10] +
+                         [ "#3\n", "-2\n",
+                           "#4\n", "1,T=1.4|2|140\n",
+                           "#6\n", "1,T=1.5|2|150\n", "-1\n",
+                           "3,T=9.1|9|9\n" ])
+
+    def test_rate_to(self):
+        # updates decimated before the cut are carried by lines at the end.
+        self.assertEqual(trim_lines(time_to=3.0, rate=0.5),
+                         trim_lines(rate=0.5)[:11] + [ "1,T=1.3|2|130\n", "3,T=9.1|9|9\n" ])
+
+    def test_rate_from(self):
+        # objects carried into the window count as updated at the first frame in the window.
+        self.assertEqual(trim_lines(time_from=2.5, rate=0.5),
+                         trim_lines(time_from=2.5)[:5] +
+                         [ "-2\n", "#5\n", "1,T=1.5|2|150\n", "#6\n", "-1\n", "3,T=9.1|9|9\n" ])
+
+    def test_cli(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            run_tvredact([ "-t", "--from", "2.5", "--rate", "0.5", os.path.join(path_data, "trim.txt.acmi") ], tmp)
+            self.assertEqual(read_bytes(os.path.join(tmp, "trim-TRIMMED.txt.acmi")).decode(),
+                             "FileType=text/acmi/tacview\nFileVersion=2.1\n" +
+                             "".join(trim_lines(time_from=2.5, rate=0.5)))
+
+if __name__ == "__main__":
+    unittest.main()
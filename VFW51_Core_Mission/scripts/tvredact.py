@@ -21,23 +21,49 @@
 #
 # *********************************************************************************************************************
 
+import collections
+import concurrent.futures
+import contextlib
+import io
+import json
+import math
 import os
 import re
-import subprocess
 import sys
+import time
+import zipfile
+
+from acmi import ACMI_FRAME, ACMI_GLOBAL, ACMI_OBJECT, ACMI_REMOVE
+from acmi import acmi_classify, acmi_line_transform, acmi_merge_transform, acmi_open_text, acmi_open_text_write, \
+    acmi_props, acmi_raw_props, acmi_read_chunks, acmi_read_header, acmi_records, acmi_records_at, \
+    acmi_replace_transform, acmi_skip_header
 
 # ---- utility functions ----------------------------------------------------------------------------------------------
 
 def usage(err):
     if err != None:
         print(err)
-    print("\ntvredact [-h|--help] [-v|--verbose] [<-d|--dump>|<<-r|--redact> <redact_file>> <acmi_path>]\n")
+    print("\ntvredact [-h|--help] [-v|--verbose] [-j|--jobs <n>] [--radius <m>] [--window <s>]")
+    print("         [--from <s>] [--to <s>] [--rate <hz>]")
+    print("         [<-d|--dump>|<-t|--trim>|<<-r|--redact|-p|--preview> <redact_file>> <acmi_path> ...]\n")
     print("    --help                  display this help")
     print("    --verbose               turn on verbose output")
-    print("    --dump                  dump object handles from <acmi_path>")
-    print("    --redact <redact_file>  redact units defined in <redact_file> from <acmi_path>\n")
-    print("Output files for \"--dump\" and \"--redact\" are created in the current directory and named as")
-    print("the input ACMI file with suffixes of \"-OBJECTS\" and \"-REDACTED\" respectively.\n")
+    print("    --dump                  dump object handles from <acmi_path> (and build its object catalog)")
+    print("    --redact <redact_file>  redact units defined in <redact_file> from <acmi_path>")
+    print("    --preview <redact_file> report what --redact would redact without writing an ACMI file")
+    print("    --trim                  trim and decimate <acmi_path> (with --from, --to, --rate) without redacting")
+    print("    --jobs <n>              redact using <n> worker processes (one file per process for multiple files)")
+    print("    --radius <m>            redact weapons that appear within <m> meters of redacted objects")
+    print("    --window <s>            redacted objects count for --radius for <s> seconds after removal")
+    print("    --from <s>              only output frames from mission time <s> seconds on")
+    print("    --to <s>                only output frames through mission time <s> seconds")
+    print("    --rate <hz>             output at most <hz> transform updates per second for each object\n")
+    print("Each <acmi_path> may be an ACMI file or a directory of ACMI files. Multiple files are processed")
+    print("with the same <redact_file> and redacting them reports a result for each file and a summary.\n")
+    print("Output files for \"--dump\", \"--redact\", and \"--trim\" are created in the current directory and")
+    print("named as the input ACMI file with suffixes of \"-OBJECTS\", \"-REDACTED\", and \"-TRIMMED\" respectively.")
+    print("Redacting a compressed (\".zip.acmi\") ACMI file produces a compressed ACMI file. \"--dump\" also builds")
+    print("an object catalog (suffix \"-CATALOG.json\") that later runs reuse until the ACMI file changes.\n")
     print("Objects in the TacView are redacted based on regex-based pattern matching with each object's")
     print("\"handle\". An object handle is of the form:\n")
     print("    <coalition>;<type>;<group>;<name>;<pilot>\n")
@@ -52,34 +78,16 @@ def usage(err):
     print("will match (and redact) any object whose <group> is \"RED SA-10-1\". The pattern,\n")
     print("    +[^;]+;[^;]+;RED EAST SA-[^;]+;[^;]+;[^;]+\n")
     print("will match (but *not* redact, due to the leading \"+\") and object whose <group> begins")
-    print("with \"RED EAST SA-\", for example \"RED EAST SA-15\" or \"RED EAST SA-8\".")
+    print("with \"RED EAST SA-\", for example \"RED EAST SA-15\" or \"RED EAST SA-8\".\n")
+    print("With \"--radius\", weapons and objects without a handle that no pattern matches are redacted if")
+    print("they appear within the radius of a redacted object (or where one was removed within the last")
+    print("\"--window\" seconds, 60 by default) so that, for example, shots do not give away a redacted site.")
     sys.exit(0)
 
-def print_verbose(msg):
-    if is_v:
-        print(msg)
-
-# build line from acmi file handling continuations.
-#
-def acmi_accumulate_continuation(fh_in, line):
-    while line.strip().endswith("\\"):
-        line = line.removesuffix("\\") + "\n" + fh_in.readline().strip()
-    return line
-
-# returns a map of properties:values (keys are always lowercase), None if the line is a "#" or "-" line (which
-# have no proerties). throws an exception if the line repeats properties.
+# functions that report progress take a log function for verbose output, log_quiet drops everything.
 #
-def acmi_line_crack(line):
-    props = None
-    if not line.startswith("#") and not line.startswith("-"):
-        fields = line.strip().split(",")
-        props = { "gid" : fields.pop(0) }
-        for prop in fields:
-            key, value = prop.split("=")
-            if key in props:
-                raise Exception(f"Property \"{key}\" duplicated?")
-            props[key.casefold()] = value
-    return props
+def log_quiet(msg):
+    pass
 
 # returns a handle for an object based on properties "<coalition>;<type>;<group>;<name>;<pilot>",
 # None if none of these properties are defined.
@@ -106,177 +114,917 @@ def acmi_object_handle(props):
             handle = None
     return handle
 
-def is_object_redacted(props, redact_regexs, state):
-    is_redacted = False
-    handle = acmi_object_handle(props)
-    if handle != None:
-        for regex in redact_regexs:
-            is_whitelist = regex.startswith("+")
-            regex.removeprefix("+")
-            regex.removeprefix("-")
-            if re.search(regex, handle, re.IGNORECASE):
-                is_redacted = not is_whitelist
-                print_verbose(f"Matched (redact = {is_redacted}): \"{handle}\" with \"{regex}\"")
-                break
-    # TODO: if handle is None, probably got a weapon? dump anything that spawns near a redacted thing?
-    return is_redacted
-
-def merge_tform(cur, next):
-    # TODO: acmi does delta updates for transforms, merge next state into current...
-    return next
+# ordered redact rule matcher built from the patterns in a redact file. rules are tried in file order and the first
+# rule that matches a handle decides whether the object is redacted (blacklist) or kept (whitelist, "+" prefix). all
+# rules are compiled once into a single case-insensitive regex where alternative i only matches if rule i matches
+# somewhere in the handle, so the alternative that matches names the first matching rule. rules with groups of their
+# own are not combined as their groups (and any backreferences to them) would be renumbered in the combined regex.
+# decisions are memoized by handle as the same handles show up over and over.
+#
+class RedactMatcher:
+    def __init__(self, patterns, log=log_quiet):
+        self.log = log
+        self.patterns = list(patterns)
+        self.rules = [ ]
+        for pattern in patterns:
+            is_whitelist = pattern.startswith("+")
+            regex = pattern.removeprefix("+").removeprefix("-")
+            try:
+                self.rules.append((is_whitelist, regex, re.compile(regex, re.IGNORECASE)))
+            except re.error as ex:
+                raise Exception(f"Invalid redact pattern \"{pattern}\", {ex}")
+        self.memo = { }
+        self.combined = None
+        if any([ rule[2].groups > 0 for rule in self.rules ]):
+            return
+        try:
+            alts = [ f"(?=[\\s\\S]*?(?:{rule[1]}))(?P<r{i}>)" for i, rule in enumerate(self.rules) ]
+            self.combined = re.compile("|".join(alts), re.IGNORECASE) if len(alts) > 0 else None
+        except re.error:
+            # patterns with inline flags, etc. cannot be combined, fall back to trying each compiled rule in order.
+            self.combined = None
 
-# ---- build --redact output file -------------------------------------------------------------------------------------
+    # returns ( is_redacted, pattern ) for a handle, where pattern is the pattern of the rule that matched the handle
+    # (None if no rule matched).
+    #
+    def match(self, handle):
+        decision = self.memo.get(handle)
+        if decision == None:
+            decision = (False, None)
+            if self.combined != None:
+                m = self.combined.match(handle)
+                if m:
+                    is_whitelist, regex, _ = self.rules[int(m.lastgroup[1:])]
+                    decision = (not is_whitelist, regex)
+            else:
+                for is_whitelist, regex, compiled in self.rules:
+                    if compiled.search(handle):
+                        decision = (not is_whitelist, regex)
+                        break
+            if decision[1] != None:
+                self.log(f"Matched (redact = {decision[0]}): \"{handle}\" with \"{decision[1]}\"")
+            self.memo[handle] = decision
+        return decision
 
-def build_redact_output(fh_in, fh_out):
-    redact_regexs = [ ]
-    with open(rdct_path, "r", encoding='utf-8') as fh_redact:
+def read_redact_matcher(path, log=log_quiet):
+    patterns = [ ]
+    with open(path, "r", encoding='utf-8') as fh_redact:
         for line in fh_redact:
-            if not line.startswith("#"):
-                redact_regexs.append(line.strip())
+            if not line.startswith("#") and len(line.strip()) > 0:
+                patterns.append(line.strip())
+    return RedactMatcher(patterns, log)
+
+# ---- acmi file access -----------------------------------------------------------------------------------------------
+
+# returns the ZipInfo for the member of a .zip acmi archive (zf, from path) that holds the acmi data: the first
+# .txt.acmi member, or the first member if there is none. throws an exception if the archive is empty.
+#
+def acmi_zip_member(zf, path):
+    members = [ m for m in zf.infolist() if not m.is_dir() ]
+    acmis = [ m for m in members if m.filename.endswith(".txt.acmi") ]
+    if len(members) == 0:
+        raise Exception(f"No ACMI data in \"{path}\"")
+    return acmis[0] if len(acmis) > 0 else members[0]
+
+# open an acmi file for reading as a binary stream, the files are closed when stack (an ExitStack) is closed. for ".zip"
+# acmi_type, the .txt.acmi member of the archive is decompressed as it is read.
+#
+def open_acmi_read_binary(stack, path, acmi_type, log=log_quiet):
+    if acmi_type != ".zip":
+        return stack.enter_context(open(path, "rb"))
+    zf = stack.enter_context(zipfile.ZipFile(path))
+    member = acmi_zip_member(zf, path)
+    log(f"Reading ACMI data from \"{member.filename}\" in \"{path}\"")
+    return stack.enter_context(zf.open(member))
+
+# open an acmi file for reading as a text stream for acmi_records(), see open_acmi_read_binary().
+#
+def open_acmi_read(stack, path, acmi_type, log=log_quiet):
+    fh_bin = open_acmi_read_binary(stack, path, acmi_type, log)
+    return stack.enter_context(acmi_open_text(fh_bin))
+
+# returns the size of the (uncompressed) acmi data in an acmi file, see open_acmi_read_binary().
+#
+def acmi_data_size(path, acmi_type):
+    if acmi_type != ".zip":
+        return os.path.getsize(path)
+    with zipfile.ZipFile(path) as zf:
+        return acmi_zip_member(zf, path).file_size
+
+# output sizes (in bytes) from which a .zip member is written with zip64 extensions. output is never much larger than
+# the acmi data it comes from (trimming can make up lines), so this leaves headroom under the 2 GiB zip limit.
+#
+acmi_zip64_size = zipfile.ZIP64_LIMIT // 2
+
+# open an acmi file for writing raw records as a text stream, the files are closed when stack (an ExitStack) is
+# closed. for ".zip" acmi_type, a .zip archive with a single .txt.acmi member is created and the data is compressed as
+# it is written. size_hint is the size of the acmi data the output comes from (see acmi_data_size()), the member only
+# uses zip64 extensions when the output might not fit without them (or size_hint is None).
+#
+def open_acmi_write(stack, path, acmi_type, size_hint=None):
+    if acmi_type != ".zip":
+        return stack.enter_context(acmi_open_text_write(open(path, "wb")))
+    member = os.path.basename(path).removesuffix(".zip.acmi") + ".txt.acmi"
+    is_zip64 = size_hint == None or size_hint >= acmi_zip64_size
+    zf = stack.enter_context(zipfile.ZipFile(path, "w", compression=zipfile.ZIP_DEFLATED))
+    return stack.enter_context(acmi_open_text_write(zf.open(member, "w", force_zip64=is_zip64)))
+
+# ---- redaction decisions --------------------------------------------------------------------------------------------
+
+# spatial index of the positions of redacted objects. positions are in meters on a flat grid with cells of size
+# cell. objects stay in the index while they are alive and for window seconds after they are removed.
+#
+class RedactGrid:
+    def __init__(self, cell, window):
+        self.cell = cell
+        self.window = window
+        self.cells = { }
+        self.where = { }
+
+    def update(self, gid, x, y):
+        key = (int(math.floor(x / self.cell)), int(math.floor(y / self.cell)))
+        old = self.where.get(gid)
+        if old != key:
+            if old != None:
+                del self.cells[old][gid]
+                if len(self.cells[old]) == 0:
+                    del self.cells[old]
+            self.cells.setdefault(key, { })[gid] = [ x, y, None ]
+            self.where[gid] = key
+        else:
+            entry = self.cells[key][gid]
+            entry[0] = x
+            entry[1] = y
+
+    def remove(self, gid, time):
+        key = self.where.get(gid)
+        if key != None:
+            self.cells[key][gid][2] = time
+
+    # returns the id of a redacted object within radius of ( x, y ) at time, None if there is no such object.
+    # objects whose removal falls outside the window are dropped from the index as they are found.
+    #
+    def find_near(self, x, y, radius, time):
+        cx = int(math.floor(x / self.cell))
+        cy = int(math.floor(y / self.cell))
+        span = int(math.ceil(radius / self.cell))
+        for key in [ (i, j) for i in range(cx - span, cx + span + 1) for j in range(cy - span, cy + span + 1) ]:
+            entries = self.cells.get(key)
+            if entries == None:
+                continue
+            for gid, (ex, ey, removed) in list(entries.items()):
+                if removed != None and time != None and time - removed > self.window:
+                    del entries[gid]
+                    del self.where[gid]
+                elif (ex - x) * (ex - x) + (ey - y) * (ey - y) <= radius * radius:
+                    return gid
+            if len(entries) == 0:
+                del self.cells[key]
+        return None
+
+# redaction decisions for the objects in an acmi file. decisions maps object ids to "REDACT" or "KEEP", objects that
+# are not in decisions have not been decided yet. an object is decided the first time it is seen with a handle that
+# redacts it or with a transform. decide() is called on every record in order and returns the decision it made for
+# the record's object (None if it did not decide anything).
+#
+# when radius is non-zero, weapons and objects without a handle that are not matched by a rule are redacted if they
+# first appear within radius meters of a redacted object (or where a redacted object was removed less than window
+# seconds before). this keeps things like sam shots from giving away the position of a redacted site. this needs
+# the merged transforms (see acmi_merge_transform()) of objects redacted by a rule, objects redacted because of
+# where they appeared are not put in the index (so one shot does not redact everything that appears near it) and
+# transforms of kept objects are never looked at.
+#
+class Redactor:
+    def __init__(self, matcher, radius=0.0, window=0.0):
+        self.matcher = matcher
+        self.radius = radius
+        self.decisions = { }
+        self.time = None
+        self.ref_lat = 0.0
+        self.tforms = { }
+        self.grid = RedactGrid(radius, window) if radius > 0.0 else None
+
+    # returns ( x, y ) in meters for a transform, None if the transform has no position. longitude and latitude
+    # are relative to the reference point from the global properties.
+    #
+    def position(self, tform):
+        try:
+            lon = float(tform[0])
+            lat = float(tform[1])
+        except (TypeError, IndexError, ValueError):
+            return None
+        return (lon * 111320.0 * math.cos(math.radians(self.ref_lat + lat)), lat * 110540.0)
 
-    state = { }
-    for line in fh_in:
-        line = acmi_accumulate_continuation(fh_in, line)
-        props = acmi_line_crack(line)
+    def track(self, gid, tform):
+        self.tforms[gid] = acmi_merge_transform(self.tforms.get(gid), tform)
+        pos = self.position(self.tforms[gid])
+        if pos != None:
+            self.grid.update(gid, pos[0], pos[1])
 
-        if props == None or (props["gid"] != None and int(props["gid"], 16) == 0):
-            fh_out.writelines([line + "\n"])
+    def is_near_redacted(self, gid, props, handle, tform):
+        if handle != None and "weapon" not in props.get("type", "").casefold() and \
+           "projectile" not in props.get("type", "").casefold():
+            return False
+        pos = self.position(acmi_merge_transform(None, tform))
+        if pos == None:
+            return False
+        near = self.grid.find_near(pos[0], pos[1], self.radius, self.time)
+        if near != None:
+            self.matcher.log(f"Redacting {gid} (\"{handle}\"), spawned near redacted {near} at {self.time}")
+        return near != None
+
+    def decide(self, kind, gid, raw):
+        if kind == ACMI_OBJECT:
+            value = self.decisions.get(gid)
+            if value == "KEEP":
+                return None
+            elif value == "REDACT":
+                if gid in self.tforms:
+                    tform = acmi_line_transform(raw)
+                    if tform != None:
+                        self.track(gid, tform)
+                return None
+
+            props = acmi_props(raw)
+            handle = acmi_object_handle(props)
+            is_redacted, pattern = self.matcher.match(handle) if handle != None else (False, None)
+            if is_redacted:
+                self.decisions[gid] = "REDACT"
+                if self.grid != None:
+                    self.tforms[gid] = None
+                    if "t" in props:
+                        self.track(gid, props["t"])
+            elif "t" in props and self.grid != None and pattern == None and \
+                 self.is_near_redacted(gid, props, handle, props["t"]):
+                self.decisions[gid] = "REDACT"
+            elif "t" in props:
+                self.decisions[gid] = "KEEP"
+            return self.decisions.get(gid)
+
+        elif kind == ACMI_FRAME and gid != None:
+            self.time = gid
+        elif kind == ACMI_REMOVE and self.grid != None and self.decisions.get(gid) == "REDACT":
+            self.grid.remove(gid, self.time)
+            self.tforms.pop(gid, None)
+        elif kind == ACMI_GLOBAL and self.grid != None and "ReferenceLatitude=" in raw:
+            try:
+                self.ref_lat = float(acmi_props(raw)["referencelatitude"])
+            except ValueError:
+                pass
+        return None
+
+# ---- trimming and decimation ----------------------------------------------------------------------------------------
+
+# returns a line that sets props (a list of ( key, value )) on object gid.
+#
+def acmi_synthesize_line(gid, props):
+    return f"{gid}," + ",".join(f"{key}={value}" for key, value in props) + "\n"
+
+# trim records (from acmi_records()) to the frames from time_from through time_to (either may be None for no limit)
+# and decimate transform updates to at most rate updates per second per object (0 for no decimation). yields the
+# records that are left along with any records that need to be made up.
+#
+# objects (and global properties) from before time_from are carried into the window as one line per object with its
+# merged properties right after the first frame in the window, events from before the window are dropped. a
+# transform-only update that is decimated is merged into the transform for its object. the next update for the
+# object that is kept (or a made up line right before the object is removed or at the end of the output) carries the
+# full merged transform so playback ends up in the same place. frames that end up empty are dropped.
+#
+def trim_records(records, time_from=None, time_to=None, rate=0.0):
+    interval = 1.0 / rate if rate > 0.0 else 0.0
+    is_before = time_from != None
+    time = None
+    frame = None
+    carried = { }
+    tforms = { }
+    written = { }
+    pending = set()
+
+    def flush_pending():
+        for gid in sorted(pending):
+            yield acmi_classify(acmi_synthesize_line(gid, [ ("T", "|".join(tforms[gid])) ]))
+        pending.clear()
+
+    for record in records:
+        kind, gid, raw = record
+        if kind == ACMI_FRAME:
+            time = gid if gid != None else time
+            if time_to != None and time != None and time > time_to:
+                break
+            elif is_before and time != None and time >= time_from:
+                is_before = False
+                yield record
+                for gid_carried, props in carried.items():
+                    props = list(props.values())
+                    if gid_carried in tforms:
+                        props.insert(0, ("T", "|".join(tforms[gid_carried])))
+                        written[gid_carried] = time
+                    if len(props) > 0:
+                        line = acmi_synthesize_line(gid_carried, props)
+                        yield acmi_classify(line)
+                carried = None
+            elif not is_before:
+                frame = record
             continue
-        elif line.startswith("-") and state[line.removeprefix("-")] != "REDACT":
-            fh_out.writelines([line + "\n"])
+
+        if is_before:
+            # before the window, merge object and global properties and drop everything else.
+            #
+            if kind == ACMI_OBJECT or kind == ACMI_GLOBAL:
+                props = carried.setdefault(gid, { })
+                for key, value in acmi_raw_props(raw):
+                    key_fold = key.casefold()
+                    if key_fold == "t":
+                        tforms[gid] = acmi_merge_transform(tforms.get(gid), value)
+                    elif key_fold != "event":
+                        props[key_fold] = (key, value)
+            elif kind == ACMI_REMOVE:
+                carried.pop(gid, None)
+                tforms.pop(gid, None)
             continue
-        elif props["gid"] in state and state[props["gid"]] != "REDACT":
-            if "t" in props:
-                state[props["gid"]] = merge_tform(state[props["gid"]], props["t"])
-            fh_out.writelines([line + "\n"])
+
+        made_up = None
+        if interval > 0.0 and kind == ACMI_OBJECT:
+            tform = acmi_line_transform(raw)
+            if tform != None:
+                tforms[gid] = acmi_merge_transform(tforms.get(gid), tform)
+                last = written.get(gid)
+                if last != None and time != None and time - last < interval and raw.count(",") == 1:
+                    pending.add(gid)
+                    continue
+                if gid in pending:
+                    pending.discard(gid)
+                    record = acmi_classify(acmi_replace_transform(raw, "|".join(tforms[gid])))
+                written[gid] = time
+        elif interval > 0.0 and kind == ACMI_REMOVE:
+            if gid in pending:
+                pending.discard(gid)
+                made_up = acmi_classify(acmi_synthesize_line(gid, [ ("T", "|".join(tforms[gid])) ]))
+            tforms.pop(gid, None)
+            written.pop(gid, None)
+
+        if frame != None:
+            yield frame
+            frame = None
+        if made_up != None:
+            yield made_up
+        yield record
+    yield from flush_pending()
+
+# ---- build --redact output file -------------------------------------------------------------------------------------
+
+# write records (from acmi_records()) to fh_out, dropping updates to and removals of redacted objects. events is a
+# list of ( index, gid, decision ) for decisions made at the index-th record, in order, that are applied to decisions
+# as the records go by.
+#
+def filter_records(records, fh_out, decisions, events):
+    events = collections.deque(events)
+    for index, (kind, gid, raw) in enumerate(records):
+        while len(events) > 0 and events[0][0] == index:
+            _, gid_event, value = events.popleft()
+            decisions[gid_event] = value
+        if (kind == ACMI_OBJECT or kind == ACMI_REMOVE) and decisions.get(gid) == "REDACT":
             continue
-        elif not props["gid"] in state and not is_object_redacted(props, redact_regexs, state):
-            if "t" in props:
-                state[props["gid"]] = merge_tform("", props["t"])
-            fh_out.writelines([line + "\n"])
-        elif not props["gid"] in state:
-            state[props["gid"]] = "REDACT"
+        fh_out.write(raw)
 
-# ---- build --dump output file ---------------------------------------------------------------------------------------
+# redact records (from acmi_records() or trim_records()) to fh_out with redactor. returns the decisions.
+#
+def build_redact_output(records, fh_out, redactor):
+    decisions = redactor.decisions
+    for kind, gid, raw in records:
+        redactor.decide(kind, gid, raw)
+        if (kind == ACMI_OBJECT or kind == ACMI_REMOVE) and decisions.get(gid) == "REDACT":
+            continue
+        fh_out.write(raw)
+    return decisions
+
+# the parallel redact pipeline splits the acmi body into frame-aligned chunks and runs two passes over them. the
+# first pass finds the record where each object is decided. without spatial redaction, decisions only depend on the
+# lines for the object so the chunks are scanned across a process pool, each from an empty Redactor, and an object
+# is decided by the first chunk (in file order) that decides it. with spatial redaction, decisions depend on what
+# came before so the chunks are scanned in order by a single Redactor. the second pass filters the chunks across
+# the pool from the decisions at the start of each chunk and the decisions made within it, so the output matches
+# the serial path byte-for-byte.
+
+acmi_chunk_size = 16 * 1024 * 1024
+
+worker_matcher = None
+
+def init_redact_worker(patterns, verbose):
+    global worker_matcher
+    worker_matcher = RedactMatcher(patterns, print if verbose else log_quiet)
+
+# chunks are either the bytes of the chunk or a ( path, start, end ) range of an uncompressed acmi file to read the
+# chunk from (see catalog_chunk_ranges()).
+#
+def acmi_chunk_records(chunk):
+    if isinstance(chunk, tuple):
+        path, start, end = chunk
+        with open(path, "rb") as fh_bin:
+            fh_bin.seek(start)
+            chunk = fh_bin.read(end - start)
+    return acmi_records(acmi_open_text(io.BytesIO(chunk)))
+
+# yield the chunks of an acmi file for the parallel pipeline. with a catalog for an uncompressed file, the chunks are
+# ranges split at the frame offsets in the catalog that the workers read directly. otherwise, the file is read here
+# and split on frame lines as it goes.
+#
+def redact_chunks(path, acmi_type, catalog, chunk_size):
+    if catalog != None and acmi_type != ".zip":
+        yield from catalog_chunk_ranges(catalog, path, chunk_size)
+    else:
+        with contextlib.ExitStack() as stack:
+            fh_bin = open_acmi_read_binary(stack, path, acmi_type)
+            acmi_skip_header(fh_bin)
+            yield from acmi_read_chunks(fh_bin, chunk_size)
 
-def build_dump_output(fh_in, fh_out):
+def scan_redact_records(records, redactor):
+    events = [ ]
+    for index, (kind, gid, raw) in enumerate(records):
+        value = redactor.decide(kind, gid, raw)
+        if value != None:
+            events.append((index, gid, value))
+    return events
+
+def scan_redact_chunk(chunk):
+    return scan_redact_records(acmi_chunk_records(chunk), Redactor(worker_matcher))
+
+def filter_redact_chunk(chunk, decisions, events):
+    fh_out = io.StringIO(newline="")
+    filter_records(acmi_chunk_records(chunk), fh_out, decisions, events)
+    return fh_out.getvalue()
+
+# map fn over args on pool yielding results in order with at most n_queue calls in flight (so we do not pull the
+# whole file into memory if the workers fall behind the reader).
+#
+def pool_map_ordered(pool, fn, args, n_queue):
+    queue = collections.deque()
+    for arg in args:
+        queue.append(pool.submit(fn, *arg))
+        if len(queue) >= n_queue:
+            yield queue.popleft().result()
+    while len(queue) > 0:
+        yield queue.popleft().result()
+
+# redact the acmi file at path to fh_out across n_jobs worker processes. catalog may be None. returns the decisions.
+#
+def build_redact_output_parallel(path, acmi_type, fh_out, matcher, n_jobs, catalog, radius, window, chunk_size):
+    with concurrent.futures.ProcessPoolExecutor(max_workers=n_jobs, initializer=init_redact_worker,
+                                                initargs=(matcher.patterns, matcher.log != log_quiet)) as pool:
+        # first pass: find the decisions made in each chunk, keeping only the first decision for each object.
+        #
+        events_by_chunk = [ ]
+        decided = set()
+        chunks = redact_chunks(path, acmi_type, catalog, chunk_size)
+        if radius > 0.0:
+            redactor = Redactor(matcher, radius, window)
+            scans = (scan_redact_records(acmi_chunk_records(chunk), redactor) for chunk in chunks)
+        else:
+            scans = pool_map_ordered(pool, scan_redact_chunk, ((chunk,) for chunk in chunks), 2 * n_jobs)
+        for events in scans:
+            events = [ event for event in events if event[1] not in decided ]
+            decided.update(event[1] for event in events)
+            events_by_chunk.append(events)
+        matcher.log(f"Decided {len(decided)} objects across {len(events_by_chunk)} chunks")
+
+        # second pass: filter each chunk from the decisions at its start, write the results in order.
+        #
+        def filter_args():
+            decisions = { }
+            for index, chunk in enumerate(redact_chunks(path, acmi_type, catalog, chunk_size)):
+                events = events_by_chunk[index] if index < len(events_by_chunk) else [ ]
+                yield (chunk, dict(decisions), events)
+                decisions.update((gid, value) for _, gid, value in events)
+
+        for text in pool_map_ordered(pool, filter_redact_chunk, filter_args(), 2 * n_jobs):
+            fh_out.write(text)
+    return { gid : value for events in events_by_chunk for _, gid, value in events }
+
+# ---- object catalog -------------------------------------------------------------------------------------------------
+
+# the catalog is a json sidecar for an acmi file built by a single pass over the file. it records, for each object
+# id, the handles the object has had, the times of its first and last lines, the byte offset of its first line, and
+# the number and size (in bytes) of its lines. "decide" holds the handles on the lines that --redact decides the
+# object from, its lines up to and including the first with a transform (see Redactor.decide()). it also records the
+# time and byte offset of every frame. offsets are into the uncompressed acmi text. the catalog is tied to the size
+# and modification time of the acmi file and is ignored once the file changes. "size" is the size of the uncompressed
+# acmi text.
+#
+#   { "version" : 3, "source" : { "size" : <int>, "mtime" : <int> }, "body" : <offset>, "size" : <int>,
+#     "frames" : [ [ <time>, <offset> ], ... ],
+#     "objects" : { <id> : { "handles" : [ <handle>, ... ], "decide" : [ <handle>, ... ], "first" : <time>,
+#                            "last" : <time>, "offset" : <offset>, "lines" : <int>, "bytes" : <int> }, ... } }
+
+catalog_version = 3
+
+# only lines that set one of the properties in a handle need to be cracked.
+#
+catalog_handle_regex = re.compile(r",(?:coalition|type|group|name|pilot)=", re.IGNORECASE)
+
+def catalog_source(path):
+    stat = os.stat(path)
+    return { "size" : stat.st_size, "mtime" : stat.st_mtime_ns }
+
+def build_catalog(path, acmi_type, log=log_quiet):
     objects = { }
-    for line in fh_in:
-        line = acmi_accumulate_continuation(fh_in, line)
-        handle = acmi_object_handle(acmi_line_crack(line))
-        if handle != None:
-            objects[handle] = True
+    undecided = set()
+    frames = [ ]
+    time = None
+    end = 0
+    with contextlib.ExitStack() as stack:
+        fh_bin = open_acmi_read_binary(stack, path, acmi_type, log)
+        body = acmi_skip_header(fh_bin)
+        end = body
+        for kind, key, raw, offset, size in acmi_records_at(fh_bin, body):
+            end = offset + size
+            if kind == ACMI_OBJECT or kind == ACMI_REMOVE:
+                entry = objects.get(key)
+                if entry == None:
+                    entry = { "handles" : [ ], "decide" : [ ], "first" : time, "last" : time, "offset" : offset,
+                              "lines" : 0, "bytes" : 0 }
+                    objects[key] = entry
+                    undecided.add(key)
+                entry["last"] = time
+                entry["lines"] += 1
+                entry["bytes"] += size
+                if kind == ACMI_OBJECT and (key in undecided or catalog_handle_regex.search(raw)):
+                    props = acmi_props(raw)
+                    handle = acmi_object_handle(props)
+                    if handle != None and handle not in entry["handles"]:
+                        entry["handles"].append(handle)
+                    if key in undecided:
+                        if handle != None and handle not in entry["decide"]:
+                            entry["decide"].append(handle)
+                        if "t" in props:
+                            undecided.discard(key)
+            elif kind == ACMI_FRAME and key != None:
+                time = key
+                frames.append([ key, offset ])
+    return { "version" : catalog_version, "source" : catalog_source(path), "body" : body, "size" : end,
+             "frames" : frames, "objects" : objects }
+
+# returns the catalog for the acmi file at acmi_path from cat_path, None if there is no catalog or it is out of date.
+#
+def read_catalog(cat_path, acmi_path, log=log_quiet):
+    try:
+        with open(cat_path, "r", encoding='utf-8', errors='surrogateescape') as fh_cat:
+            catalog = json.load(fh_cat)
+    except (OSError, ValueError):
+        return None
+    if catalog.get("version") != catalog_version or catalog.get("source") != catalog_source(acmi_path):
+        log(f"Catalog \"{cat_path}\" is out of date")
+        return None
+    return catalog
+
+def write_catalog(cat_path, catalog):
+    with open(cat_path, "w", encoding='utf-8', errors='surrogateescape') as fh_cat:
+        json.dump(catalog, fh_cat, separators=(",", ":"))
+
+# returns the catalog for the acmi file at acmi_path, building and writing it to cat_path if needed.
+#
+def load_catalog(cat_path, acmi_path, acmi_type, log=log_quiet):
+    catalog = read_catalog(cat_path, acmi_path, log)
+    if catalog == None:
+        log(f"Building catalog \"{cat_path}\"")
+        catalog = build_catalog(acmi_path, acmi_type, log)
+        write_catalog(cat_path, catalog)
+    return catalog
+
+# yield ( path, start, end ) ranges of the body of an uncompressed acmi file split at frames from the catalog every
+# chunk_size bytes or so.
+#
+def catalog_chunk_ranges(catalog, path, chunk_size):
+    start = catalog["body"]
+    for _, offset in catalog["frames"]:
+        if offset - start >= chunk_size:
+            yield (path, start, offset)
+            start = offset
+    if catalog["size"] > start:
+        yield (path, start, catalog["size"])
+
+# ---- build --dump output file ---------------------------------------------------------------------------------------
+
+def build_dump_output(catalog, fh_out):
+    handles = set()
+    for entry in catalog["objects"].values():
+        handles.update(entry["handles"])
 
     fh_out.writelines([ "# <coalition>;<type>;<group>;<name>;<pilot>\n"])
-    fh_out.writelines([ s + "\n" for s in sorted(objects.keys()) ])
+    fh_out.writelines([ s + "\n" for s in sorted(handles) ])
 
-# ---- command line parsing -------------------------------------------------------------------------------------------
+# ---- build --preview output ------------------------------------------------------------------------------------------
 
-is_v = False
-is_r = False
-is_d = False
-acmi_type = None
-acmi_path = None
-rdct_path = None
-
-for i in range(1, len(sys.argv)):
-    if sys.argv[i] == "-h" or sys.argv[i] == "--help":
-        usage(None)
-    elif sys.argv[i] == "-v" or sys.argv[i] == "--verbose":
-        is_v = True
-    elif sys.argv[i] == "-d" or sys.argv[i] == "--dump":
-        is_d = True
-    elif sys.argv[i] == "-r" or sys.argv[i] == "--redact":
-        is_r = True
-    elif not sys.argv[i].startswith("-"):
-        if is_r and rdct_path == None:
-            rdct_path = sys.argv[i]
-            if not os.path.isfile(rdct_path) or not os.access(rdct_path, os.R_OK):
-                usage(f"Unable to access redact file \"{rdct_path}\"")
-        elif acmi_path == None:
-            acmi_path = sys.argv[i]
-            if acmi_path.endswith(".acmi"):
-                file = acmi_path.removesuffix(".acmi")
-                if file.endswith(".zip"):
-                    acmi_type = ".zip"
-                elif file.endswith(".txt"):
-                    acmi_type = ".txt"
-            if acmi_type == None:
-                usage(f"ACMI file \"{acmi_path}\" does not have expected extension (\".txt.acmi\" or \".zip.acmi\")")
-            elif not os.path.isfile(acmi_path) or not os.access(acmi_path, os.R_OK):
-                usage(f"Unable to access ACMI file \"{acmi_path}\"")
-        else:
-            usage(f"Unexpected command line argument \"{sys.argv[i]}\"")
-    else:
-        usage(f"Unknown command line switch \"{sys.argv[i]}\"")
-if (not is_r and not is_d) or (is_r and is_d) or (is_r and rdct_path == None) or acmi_path == None:
-    usage(f"Error in command line")
+# report what a redact file would do to the objects in the catalog without writing an acmi file. objects are decided
+# as --redact decides them, redacted if a handle on one of their lines up to their first transform is redacted (see
+# build_catalog()). objects redacted by --radius are not included. the line and byte counts include every line of a
+# redacted object, --redact writes out lines of an object that come before the line it is redacted on.
+#
+def build_preview_output(catalog, matcher, fh_out):
+    handles = { }
+    for entry in catalog["objects"].values():
+        for handle in entry["handles"]:
+            handles[handle] = matcher.match(handle)
+
+    fh_out.write("# <action> <coalition>;<type>;<group>;<name>;<pilot> <rule>\n")
+    for handle in sorted(handles.keys()):
+        is_redacted, pattern = handles[handle]
+        if pattern != None:
+            action = "redact" if is_redacted else "keep  "
+            rule = pattern if is_redacted else f"+{pattern}"
+            fh_out.write(f"{action} {handle} {rule}\n")
+
+    n_objects = 0
+    n_lines = 0
+    n_bytes = 0
+    for entry in catalog["objects"].values():
+        if any([ matcher.match(handle)[0] for handle in entry["decide"] ]):
+            n_objects += 1
+            n_lines += entry["lines"]
+            n_bytes += entry["bytes"]
+    size = max(catalog["size"], 1)
+    fh_out.write(f"\nWould redact {n_objects} of {len(catalog['objects'])} objects, {n_lines} lines, {n_bytes} bytes" +
+                 f" ({100.0 * n_bytes / size:.1f}% of the file)\n")
 
-# ---- rehydrate compressed <acmi_file> -------------------------------------------------------------------------------
+# ---- library interface ----------------------------------------------------------------------------------------------
 
-# acmi files come in compressed (.zip.acmi) and uncompressed flavors (.txt.acmi). compressed files are basically
-# just a zip archive with an uncompressed file (so, tv.zip.acmi is a .zip archive containing tv.txt.acmi).
+# tvredact can be imported and driven through redact(), redact_batch(), dump(), and preview(). rules may be the path
+# to a redact file, a list of patterns (as they would appear in a redact file), or a RedactMatcher.
+
+# returns the acmi type of a path from its extension, ".zip" for .zip.acmi and ".txt" for .txt.acmi files, None if
+# the path is not an acmi file.
+#
+def acmi_path_type(path):
+    if path.endswith(".zip.acmi"):
+        return ".zip"
+    elif path.endswith(".txt.acmi"):
+        return ".txt"
+    return None
+
+# returns the default path for an output file for the acmi file at path with a suffix of "REDACTED", "TRIMMED",
+# "OBJECTS", or "CATALOG". outputs are in the current directory and named as the acmi file with the suffix.
 #
-# if we are working on a compressed file, uncompress it first with 7z.exe leaving us with a .txt.acmi file that
-# we will blow away before exiting.
+def acmi_output_path(path, suffix):
+    acmi_type = acmi_path_type(path)
+    acmi_base = os.path.basename(path).removesuffix(f"{acmi_type}.acmi")
+    if suffix == "OBJECTS":
+        return f"{acmi_base}-OBJECTS.txt"
+    elif suffix == "CATALOG":
+        return f"{acmi_base}-CATALOG.json"
+    return f"{acmi_base}-{suffix}{acmi_type}.acmi"
+
+def make_matcher(rules, log=log_quiet):
+    if isinstance(rules, RedactMatcher):
+        return rules
+    elif isinstance(rules, str):
+        return read_redact_matcher(rules, log)
+    return RedactMatcher(rules, log)
 
-try:
-    if acmi_type == ".zip":
-        print_verbose(f"Extracting ACMI data from \"{acmi_path}\"...")
-        subprocess.run(f"tar xf {acmi_path}", stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        head, tail = os.path.split(acmi_path)
-        acmi_path = tail.removesuffix(".zip.acmi") + ".txt.acmi"
-except:
-    print("Unable to extract uncompressed ACMI data from \"{acmi_path}\", exiting")
-    sys.exit(-1)
+# redact the acmi file at input_path to output_path (a compressed file if output_path ends in .zip.acmi) with rules.
+# with jobs > 1, the file is redacted across a pool of that many processes. the catalog at catalog_path (if given and
+# up to date) is used to split the file for the pool. time_from, time_to, and rate trim and decimate the output (see
+# trim_records()), this always runs in a single process. returns a summary of the redaction,
+#
+#   { "input" : <path>, "output" : <path>, "objects" : <int>, "redacted" : <int>, "size_in" : <int>,
+#     "size_out" : <int>, "seconds" : <float> }
+#
+# where objects is the number of objects decided and redacted is the number of those that were redacted. throws an
+# exception if the file cannot be redacted.
+#
+def redact(input_path, output_path, rules, jobs=1, radius=0.0, window=60.0, catalog_path=None, time_from=None,
+           time_to=None, rate=0.0, log=log_quiet):
+    time_start = time.time()
+    in_type = acmi_path_type(input_path)
+    out_type = acmi_path_type(output_path)
+    if in_type == None or out_type == None:
+        raise Exception(f"ACMI files must have a \".txt.acmi\" or \".zip.acmi\" extension")
+    matcher = make_matcher(rules, log)
+    is_trim = time_from != None or time_to != None or rate > 0.0
+    if is_trim and jobs > 1:
+        log(f"Trimming {input_path} in a single process")
+        jobs = 1
 
-print_verbose(f"Processing ACMI data from \"{acmi_path}\"")
+    with contextlib.ExitStack() as stack:
+        fh_in = open_acmi_read(stack, input_path, in_type, log)
+        ln_ft, ln_fv, ln_raw = acmi_read_header(fh_in, input_path)
+        log(f"{input_path} has type \"{ln_ft}\", version \"{ln_fv}\"")
+        fh_out = open_acmi_write(stack, output_path, out_type, acmi_data_size(input_path, in_type))
+        fh_out.write(ln_raw)
+        if jobs > 1:
+            catalog = read_catalog(catalog_path, input_path, log) if catalog_path != None else None
+            decisions = build_redact_output_parallel(input_path, in_type, fh_out, matcher, jobs, catalog, radius,
+                                                     window, acmi_chunk_size)
+        else:
+            records = acmi_records(fh_in)
+            if is_trim:
+                records = trim_records(records, time_from, time_to, rate)
+            decisions = build_redact_output(records, fh_out, Redactor(matcher, radius, window))
 
-# ---- build output path ----------------------------------------------------------------------------------------------
+    return { "input" : input_path, "output" : output_path, "objects" : len(decisions),
+             "redacted" : sum(1 for value in decisions.values() if value == "REDACT"),
+             "size_in" : os.path.getsize(input_path), "size_out" : os.path.getsize(output_path),
+             "seconds" : time.time() - time_start }
 
-# output files are stored in the current directory.
+def redact_batch_job(input_path, output_path, patterns, radius, window, time_from, time_to, rate):
+    try:
+        return redact(input_path, output_path, patterns, 1, radius, window, None, time_from, time_to, rate), None
+    except Exception as ex:
+        return None, str(ex)
 
-head, tail = os.path.split(acmi_path)
-acmi_base = tail.removesuffix(".txt.acmi")
-if is_r:
-    output_path = f"{acmi_base}-REDACTED.txt.acmi"
-elif is_d:
-    output_path = f"{acmi_base}-OBJECTS.txt"
-print_verbose(f"Outputting results to \"{output_path}\"")
+# redact a list of ( input_path, output_path ) acmi files with rules across a pool of jobs processes, each file is
+# redacted by a single process. yields ( input_path, summary, error ) in list order as files finish, where summary
+# is from redact() (None on errors) and error describes why the file could not be redacted (None on success).
+# throws an exception before redacting anything if two files have the same output path.
+#
+def redact_batch(paths, rules, jobs=1, radius=0.0, window=60.0, time_from=None, time_to=None, rate=0.0,
+                 log=log_quiet):
+    collisions = find_output_collisions([ output_path for _, output_path in paths ])
+    if len(collisions) > 0:
+        raise Exception(f"Multiple files would be output to {', '.join(collisions)}")
+    patterns = make_matcher(rules, log).patterns
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max(1, min(jobs, len(paths)))) as pool:
+        futures = [ pool.submit(redact_batch_job, input_path, output_path, patterns, radius, window, time_from,
+                                time_to, rate)
+                    for input_path, output_path in paths ]
+        for (input_path, _), future in zip(paths, futures):
+            summary, error = future.result()
+            yield input_path, summary, error
 
-# ---- process input files --------------------------------------------------------------------------------------------
+# returns the output paths that appear more than once in output_paths (comparing resolved paths), in order.
+#
+def find_output_collisions(output_paths):
+    counts = collections.Counter([ os.path.normcase(os.path.realpath(path)) for path in output_paths ])
+    collisions = [ ]
+    for path in output_paths:
+        if counts[os.path.normcase(os.path.realpath(path))] > 1 and path not in collisions:
+            collisions.append(path)
+    return collisions
 
-with open(output_path, "w", encoding='utf-8') as fh_out:
-    with open(acmi_path, "r", encoding='utf-8') as fh_in:
+# dump the object handles from the acmi file at input_path to output_path using (and, if needed, building) the
+# catalog at catalog_path.
+#
+def dump(input_path, output_path, catalog_path, log=log_quiet):
+    catalog = load_catalog(catalog_path, input_path, acmi_path_type(input_path), log)
+    with open(output_path, "w", encoding='utf-8', errors='surrogateescape') as fh_out:
+        build_dump_output(catalog, fh_out)
 
-        # check the header lines from the .acmi file and verify the version. mind the utf-8 BOM bogosity
-        # at the start of the file. if we're -r, we emit these to the output file (which is an .acmi).
-        #
-        ln_ft = fh_in.readline().strip()
-        ln_fv = fh_in.readline().strip()
-        if not ln_ft.casefold().endswith("filetype=text/acmi/tacview") or \
-            not ln_fv.casefold().startswith("fileversion=2."):
-            raise Exception(f"Unsupported file format for {acmi_path}")
+# write a preview of redacting the acmi file at input_path with rules to fh_out using (and, if needed, building) the
+# catalog at catalog_path.
+#
+def preview(input_path, rules, fh_out, catalog_path, log=log_quiet):
+    catalog = load_catalog(catalog_path, input_path, acmi_path_type(input_path), log)
+    build_preview_output(catalog, make_matcher(rules, log), fh_out)
+
+# ---- command line parsing -------------------------------------------------------------------------------------------
+
+# returns the acmi files at path, the path itself for a file or the .txt.acmi and .zip.acmi files in it for a
+# directory (skipping files tvredact outputs).
+#
+def expand_acmi_path(path):
+    if not os.path.isdir(path):
+        return [ path ]
+    files = [ ]
+    for name in sorted(os.listdir(path)):
+        if acmi_path_type(name) != None and \
+            not name.endswith(("-REDACTED.txt.acmi", "-REDACTED.zip.acmi", "-TRIMMED.txt.acmi", "-TRIMMED.zip.acmi")):
+            files.append(os.path.join(path, name))
+    return files
+
+def main():
+    is_v = False
+    is_r = False
+    is_d = False
+    is_p = False
+    is_t = False
+    n_jobs = 1
+    radius = 0.0
+    window = 60.0
+    time_from = None
+    time_to = None
+    rate = 0.0
+    rdct_path = None
+    acmi_paths = [ ]
+
+    i = 1
+    while i < len(sys.argv):
+        if sys.argv[i] == "-h" or sys.argv[i] == "--help":
+            usage(None)
+        elif sys.argv[i] == "-v" or sys.argv[i] == "--verbose":
+            is_v = True
+        elif sys.argv[i] == "-d" or sys.argv[i] == "--dump":
+            is_d = True
+        elif sys.argv[i] == "-r" or sys.argv[i] == "--redact":
+            is_r = True
+        elif sys.argv[i] == "-p" or sys.argv[i] == "--preview":
+            is_p = True
+        elif sys.argv[i] == "-t" or sys.argv[i] == "--trim":
+            is_t = True
+        elif sys.argv[i] == "-j" or sys.argv[i] == "--jobs":
+            i += 1
+            if i == len(sys.argv) or not sys.argv[i].isdigit() or int(sys.argv[i]) < 1:
+                usage(f"Expected a job count after \"{sys.argv[i-1]}\"")
+            n_jobs = int(sys.argv[i])
+        elif sys.argv[i] in [ "--radius", "--window", "--from", "--to", "--rate" ]:
+            i += 1
+            try:
+                value = float(sys.argv[i]) if i < len(sys.argv) else -1.0
+            except ValueError:
+                value = -1.0
+            if value < 0.0:
+                usage(f"Expected a non-negative number after \"{sys.argv[i-1]}\"")
+            if sys.argv[i-1] == "--radius":
+                radius = value
+            elif sys.argv[i-1] == "--window":
+                window = value
+            elif sys.argv[i-1] == "--from":
+                time_from = value
+            elif sys.argv[i-1] == "--to":
+                time_to = value
+            else:
+                rate = value
+        elif not sys.argv[i].startswith("-"):
+            if (is_r or is_p) and rdct_path == None:
+                rdct_path = sys.argv[i]
+                if not os.path.isfile(rdct_path) or not os.access(rdct_path, os.R_OK):
+                    usage(f"Unable to access redact file \"{rdct_path}\"")
+            else:
+                for acmi_path in expand_acmi_path(sys.argv[i]):
+                    if acmi_path_type(acmi_path) == None:
+                        usage(f"ACMI file \"{acmi_path}\" does not have expected extension " +
+                              "(\".txt.acmi\" or \".zip.acmi\")")
+                    elif not os.path.isfile(acmi_path) or not os.access(acmi_path, os.R_OK):
+                        usage(f"Unable to access ACMI file \"{acmi_path}\"")
+                    acmi_paths.append(acmi_path)
         else:
-            print_verbose(f"{acmi_path} has type \"{ln_ft}\", version \"{ln_fv}\"")
-
-        if is_d:
-            build_dump_output(fh_in, fh_out)
-        elif is_r:
-            fh_out.writelines([f"{ln_ft}\n", f"{ln_fv}\n"])
-            build_redact_output(fh_in, fh_out)
-
-try:
-    if acmi_type == ".zip":
-        print_verbose(f"Removing temporary file \"{acmi_path}\" extracted from .zip.acmi file")
-        os.remove(acmi_path)
-
-        if is_r:
-            zip_path = output_path.removesuffix(".txt.acmi") + ".zip.acmi"
-            # TODO: for some reason, windoze does not like the frickin' .zips created by 7z or tar? wtaf msft?
-            #print_verbose(f"Compressing ACMI output file from \"{output_path}\" to \"{zip_path}\"...")
-            #subprocess.run(f"tar cf {zip_path} {output_path}", stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-            #os.remove(output_path)
-except:
-    print("Unable to clean up, exiting")
-    sys.exit(-1)
+            usage(f"Unknown command line switch \"{sys.argv[i]}\"")
+        i += 1
+    if [ is_r, is_d, is_p, is_t ].count(True) != 1 or ((is_r or is_p) and rdct_path == None) or len(acmi_paths) == 0:
+        usage(f"Error in command line")
+
+    log = print if is_v else log_quiet
+
+    # ---- process input files ----------------------------------------------------------------------------------------
+
+    # acmi files come in compressed (.zip.acmi) and uncompressed flavors (.txt.acmi). compressed files are basically
+    # just a zip archive with an uncompressed file (so, tv.zip.acmi is a .zip archive containing tv.txt.acmi).
+    #
+    # compressed files are decompressed as they are read and compressed as they are written, nothing is extracted to
+    # disk. output files are stored in the current directory (see acmi_output_path()). redacting a compressed file
+    # produces a compressed file. with more than one job, a single file is redacted across a process pool (reading
+    # the input twice, see build_redact_output_parallel()) while multiple files are redacted one file per process.
+    # trimming is redacting with no rules.
+
+    try:
+        matcher = read_redact_matcher(rdct_path, log) if rdct_path != None else RedactMatcher([ ], log)
+    except Exception as ex:
+        print(f"Unable to read redact file \"{rdct_path}\", {ex}")
+        sys.exit(-1)
+
+    # outputs are named from the input file name, so files with the same name in different directories would write
+    # the same output.
+    suffix = "TRIMMED" if is_t else "REDACTED"
+    if not is_p:
+        collisions = find_output_collisions([ acmi_output_path(acmi_path, "OBJECTS" if is_d else suffix)
+                                              for acmi_path in acmi_paths ])
+        if len(collisions) > 0:
+            usage(f"Multiple ACMI files would be output to {', '.join(collisions)}")
+
+    if (is_r or is_t) and len(acmi_paths) > 1:
+        paths = [ (acmi_path, acmi_output_path(acmi_path, suffix)) for acmi_path in acmi_paths ]
+        n_failed = 0
+        for acmi_path, summary, error in redact_batch(paths, matcher, n_jobs, radius, window, time_from, time_to,
+                                                      rate, log):
+            if error != None:
+                n_failed += 1
+                print(f"{acmi_path}: FAILED, {error}")
+            else:
+                print(f"{acmi_path}: redacted {summary['redacted']} of {summary['objects']} objects to " +
+                      f"{summary['output']}, {summary['size_in']} -> {summary['size_out']} bytes in " +
+                      f"{summary['seconds']:.1f}s")
+        print(f"Processed {len(paths) - n_failed} of {len(paths)} files, {n_failed} failed")
+        if n_failed > 0:
+            sys.exit(-1)
+        return
+
+    for acmi_path in acmi_paths:
+        cat_path = acmi_output_path(acmi_path, "CATALOG")
+        log(f"Processing ACMI data from \"{acmi_path}\"")
+        try:
+            if is_d:
+                output_path = acmi_output_path(acmi_path, "OBJECTS")
+                log(f"Outputting results to \"{output_path}\"")
+                dump(acmi_path, output_path, cat_path, log)
+            elif is_p:
+                if len(acmi_paths) > 1:
+                    print(f"\n# {acmi_path}")
+                preview(acmi_path, matcher, sys.stdout, cat_path, log)
+            else:
+                output_path = acmi_output_path(acmi_path, suffix)
+                log(f"Outputting results to \"{output_path}\"")
+                redact(acmi_path, output_path, matcher, n_jobs, radius, window, cat_path, time_from, time_to, rate,
+                       log)
+        except Exception as ex:
+            print(f"Unable to process ACMI data from \"{acmi_path}\", {ex}")
+            sys.exit(-1)
+
+if __name__ == "__main__":
+    main()